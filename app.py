@@ -20,22 +20,67 @@ Loop (Mattermost) → YouGile бот.
 
 import os
 import json
+import atexit
 import time
 import threading
 import re
-from datetime import datetime, timedelta, date, timezone
-from collections import defaultdict
+import select
+import socket
+import ssl
+import functools
+import heapq
+import logging
+import queue
+import uuid
+from datetime import timedelta, date
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from urllib.parse import quote
 
+try:
+    import orjson
+except ImportError:  # без orjson работаем на стандартном json
+    orjson = None
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.fields import RequestField
+from urllib3.util.retry import Retry
 from flask import Flask, request
-from websocket import create_connection, WebSocketConnectionClosedException
+from websocket import ABNF, create_connection, WebSocketConnectionClosedException
+
+
+# ---------------------------------------------------------------------------
+#  JSON: orjson, если установлен (быстрее stdlib в разы), иначе стандартный json
+# ---------------------------------------------------------------------------
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует obj в JSON (UTF-8 bytes)."""
+        return orjson.dumps(obj)
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует obj в JSON (UTF-8 bytes)."""
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
 
 
 # ---------------------------------------------------------------------------
 #  Вспомогательное: преобразование названия проекта в slug для URL
 # ---------------------------------------------------------------------------
 
+DASHES_RE = re.compile(r"-{2,}")
+# Символы, которые quote() оставляет как есть: для таких slug'ов quote можно не вызывать
+SLUG_SAFE_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_.-~/")
+
+
+# Проектов у команды немного, а slug нужен при каждом создании задачи
+@functools.lru_cache(maxsize=512)
 def slugify_title(title: str) -> str:
     """
     Превращает название проекта в slug для URL YouGile:
@@ -43,18 +88,46 @@ def slugify_title(title: str) -> str:
     - несколько дефисов подряд схлопываются
     - строка URL-энкодится
     """
-    s = (title or "").strip()
-    s = re.sub(r"\s+", "-", s)   # пробелы → дефисы
-    s = re.sub(r"-+", "-", s)    # схлопываем повторяющиеся дефисы
+    s = "-".join((title or "").split())   # пробелы → дефисы (split уже схлопывает пробелы)
+    if "--" in s:
+        s = DASHES_RE.sub("-", s)   # схлопываем повторяющиеся дефисы
+    if SLUG_SAFE_CHARS.issuperset(s):
+        return s
     return quote(s)
 
 
+# ---------------------------------------------------------------------------
+#  Логирование
+# ---------------------------------------------------------------------------
+
+logger = logging.getLogger("yougile_bot")
+
+
+def setup_logging():
+    """
+    Логи пишутся в stderr из отдельного потока QueueListener:
+    обработчики только кладут запись в очередь и не ждут вывода.
+    """
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] %(message)s"))
+    listener = QueueListener(log_queue, stream_handler)
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger.setLevel(LOG_LEVEL)
+
+    listener.start()
+    atexit.register(listener.stop)
+
+
 # ---------------------------------------------------------------------------
 #  ENV / конфиг
 # ---------------------------------------------------------------------------
 
 # Через сколько минут после неактивности автозавершать диалог (OPTIONAL_ATTACH)
 AUTO_FINISH_TIMEOUT_MINUTES = int(os.getenv("AUTO_FINISH_TIMEOUT_MINUTES", "5"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
 MM_URL = os.getenv("MM_URL", "").rstrip("/")
 MM_BOT_TOKEN = os.getenv("MM_BOT_TOKEN")
@@ -71,10 +144,33 @@ if not YOUGILE_TEAM_ID and YOUGILE_COMPANY_ID:
     YOUGILE_TEAM_ID = YOUGILE_COMPANY_ID.split("-")[-1]
 
 if not (MM_URL and MM_BOT_TOKEN and YOUGILE_COMPANY_ID and YOUGILE_API_KEY and BOT_PUBLIC_URL):
-    print("ERROR: some required env vars are missing (MM_URL / MM_BOT_TOKEN / YOUGILE_* / BOT_PUBLIC_URL)")
+    logger.error("some required env vars are missing (MM_URL / MM_BOT_TOKEN / YOUGILE_* / BOT_PUBLIC_URL)")
     # Не выходим, чтобы это было видно в логах, но бот работать не будет.
 
+# user_id бота: запрашивается один раз при старте (refresh_bot_user_id)
 BOT_USER_ID = None
+BOT_USER_ID_LOCK = threading.Lock()
+
+# ---------------------------------------------------------------------------
+#  URL API (собираются один раз при старте)
+# ---------------------------------------------------------------------------
+
+MM_API_URL = f"{MM_URL}/api/v4"
+MM_USERS_URL = f"{MM_API_URL}/users"
+MM_USERS_ME_URL = f"{MM_USERS_URL}/me"
+MM_CHANNELS_URL = f"{MM_API_URL}/channels"
+MM_POSTS_URL = f"{MM_API_URL}/posts"
+MM_EPHEMERAL_POSTS_URL = f"{MM_POSTS_URL}/ephemeral"
+MM_REACTIONS_URL = f"{MM_API_URL}/reactions"
+MM_FILES_URL = f"{MM_API_URL}/files"
+
+YG_PROJECTS_URL = f"{YOUGILE_BASE_URL}/projects"
+YG_BOARDS_URL = f"{YOUGILE_BASE_URL}/boards"
+YG_COLUMNS_URL = f"{YOUGILE_BASE_URL}/columns"
+YG_USERS_URL = f"{YOUGILE_BASE_URL}/users"
+YG_TASKS_URL = f"{YOUGILE_BASE_URL}/tasks"
+YG_CHATS_URL = f"{YOUGILE_BASE_URL}/chats"
+YG_UPLOAD_FILE_URL = f"{YOUGILE_BASE_URL}/upload-file"
 
 # ---------------------------------------------------------------------------
 #  HTTP-заголовки
@@ -93,13 +189,311 @@ yg_headers = {
 }
 
 
+# ---------------------------------------------------------------------------
+#  HTTP-сессии (пул соединений к Loop и YouGile)
+# ---------------------------------------------------------------------------
+
+# Таймауты (connect, read): соединение должно устанавливаться быстро,
+# а на чтение даём больше времени — особенно при передаче файлов.
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, 10)
+UPLOAD_TIMEOUT = (HTTP_CONNECT_TIMEOUT, 60)
+
+# Размер пула соединений на хост: с запасом покрывает одновременные обработчики
+# webhook'ов Flask, событий WS и фоновые запросы IO_POOL.
+HTTP_POOL_CONNECTIONS = 32
+HTTP_POOL_MAXSIZE = 64
+
+
+# Повторяются только идемпотентные запросы: чтение, удаление постов и PUT-правки постов Loop
+HTTP_RETRY_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "DELETE", "PUT"})
+# Дольше этого (в секундах) на Retry-After не ждём: поток не должен висеть минутами
+HTTP_RETRY_AFTER_MAX = 1.0
+
+
+class CappedRetry(Retry):
+    """Retry, который учитывает Retry-After, но не дольше HTTP_RETRY_AFTER_MAX секунд."""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, HTTP_RETRY_AFTER_MAX)
+
+
+def make_session(headers):
+    """
+    Создаёт requests.Session с заголовками по умолчанию и пулом соединений,
+    чтобы не открывать новое TCP+TLS соединение на каждый запрос.
+    Идемпотентные запросы (HTTP_RETRY_METHODS) повторяются при 502/503/504, а также
+    при 429 (YouGile ограничивает частоту запросов) — Retry-After учитывается с потолком.
+    Когда попытки кончились, возвращается последний ответ (raise_on_status=False):
+    его статус проверяет raise_for_status, и предохранитель видит реальный код.
+    """
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=CappedRetry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=HTTP_RETRY_METHODS,
+            raise_on_status=False,
+        ),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+mm_session = make_session(mm_headers)
+yg_session = make_session(yg_headers)
+
+# Пул потоков для параллельных независимых запросов к Loop / YouGile
+IO_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="io")
+
+
+class OrderedDispatcher:
+    """
+    Выполняет задачи в пуле потоков, сохраняя порядок задач с одинаковым ключом:
+    задачи разных ключей идут параллельно, задачи одного ключа — строго друг за другом.
+    max_pending — сколько задач может ждать выполнения; если очередь полна,
+    submit ждёт освобождения места не дольше pending_timeout секунд,
+    а не дождавшись — отбрасывает задачу и возвращает False.
+    """
+
+    def __init__(self, pool, max_pending=None, pending_timeout=None):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.queues = {}  # key -> deque[(func, args)]
+        self.pending = threading.BoundedSemaphore(max_pending) if max_pending else None
+        self.pending_timeout = pending_timeout
+
+    def submit(self, key, func, *args):
+        """Ставит задачу в очередь ключа key; False — очередь переполнена, задача отброшена."""
+        if self.pending is not None and not self.pending.acquire(timeout=self.pending_timeout):
+            logger.warning("Dispatcher queue is full, dropping task %s for key %s", func.__name__, key)
+            return False
+        with self.lock:
+            pending_tasks = self.queues.get(key)
+            if pending_tasks is not None:
+                # по этому ключу уже работает поток — он заберёт задачу следом
+                pending_tasks.append((func, args))
+                return True
+            self.queues[key] = deque([(func, args)])
+        self.pool.submit(self.run_queue, key)
+        return True
+
+    def run_queue(self, key):
+        while True:
+            with self.lock:
+                pending_tasks = self.queues[key]
+                if not pending_tasks:
+                    del self.queues[key]
+                    return
+                func, args = pending_tasks.popleft()
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Error in dispatched task")
+            finally:
+                if self.pending is not None:
+                    self.pending.release()
+
+
+# ---------------------------------------------------------------------------
+#  Предохранитель (circuit breaker) для запросов к YouGile
+# ---------------------------------------------------------------------------
+
+# После стольких сбоев подряд YouGile считается недоступным...
+YG_BREAKER_FAIL_MAX = 5
+# ...и на столько секунд все запросы к нему сразу отклоняются
+YG_BREAKER_RESET_TIMEOUT = 30
+
+YG_UNAVAILABLE_MESSAGE = "YouGile сейчас недоступен. Попробуйте создать задачу чуть позже."
+YG_COMMENT_UNAVAILABLE_MESSAGE = (
+    "YouGile сейчас недоступен — сообщение не передано в чат задачи. "
+    "Отправьте его ещё раз чуть позже."
+)
+
+
+class CircuitOpenError(Exception):
+    """Предохранитель разомкнут: запрос не отправлялся."""
+
+
+class CircuitBreaker:
+    """
+    Считает сбои подряд (сеть, таймауты, 5xx). После fail_max сбоев размыкается
+    и reset_timeout секунд отклоняет вызовы, не занимая потоки ожиданием таймаутов.
+    Затем пропускает один пробный вызов: успех замыкает цепь, сбой — размыкает снова.
+    """
+
+    def __init__(self, fail_max, reset_timeout):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            now = time.monotonic()
+            if now - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError(YG_UNAVAILABLE_MESSAGE)
+            # пробный вызов; остальные до его результата по-прежнему отклоняются
+            self._opened_at = now
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.fail_max:
+                self._opened_at = time.monotonic()
+
+
+def is_service_failure(e):
+    """
+    Сбой сервиса, а не ошибка запроса: нет ответа (сеть / таймаут) или 5xx.
+    Ограничение частоты (429, исчерпанные повторы RetryError) сбоем не считается.
+    """
+    if isinstance(e, requests.exceptions.RetryError):
+        return False
+    response = getattr(e, "response", None)
+    return response is None or response.status_code >= 500
+
+
+def guarded_by(breaker):
+    """Декоратор: пропускает вызовы функции через предохранитель breaker."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            breaker.before_call()
+            try:
+                result = func(*args, **kwargs)
+            except requests.RequestException as e:
+                if is_service_failure(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                raise
+            breaker.record_success()
+            return result
+        return wrapper
+    return decorator
+
+
+YG_BREAKER = CircuitBreaker(YG_BREAKER_FAIL_MAX, YG_BREAKER_RESET_TIMEOUT)
+
+
+# ---------------------------------------------------------------------------
+#  TTL-кеш для справочных запросов к YouGile и Mattermost
+# ---------------------------------------------------------------------------
+
+# Время жизни закешированных ответов, в секундах
+YG_PROJECTS_TTL = 15 * 60
+YG_BOARDS_TTL = 10 * 60
+YG_COLUMNS_TTL = 5 * 60
+YG_USERS_TTL = 30 * 60
+MM_USERS_TTL = 5 * 60  # сбрасывается по событию WS user_updated
+MM_CHANNELS_TTL = 60
+
+# Потолок числа записей в кеше (пользователи MM кешируются по одному)
+API_CACHE_MAX_ENTRIES = 512
+
+
+class TTLCache:
+    """Потокобезопасный словарь key -> (expires_at, value) с истечением по времени."""
+
+    def __init__(self, maxsize=API_CACHE_MAX_ENTRIES):
+        self._data = {}
+        self._lock = threading.Lock()
+        self._maxsize = maxsize
+
+    def get(self, key):
+        """Возвращает (True, value) для живой записи, иначе (False, None)."""
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return False, None
+            expires_at, value = item
+            if expires_at <= now:
+                self._data.pop(key, None)
+                return False, None
+            return True, value
+
+    def set(self, key, value, ttl):
+        now = time.monotonic()
+        with self._lock:
+            self._data.pop(key, None)
+            if len(self._data) >= self._maxsize:
+                # Сначала выкидываем протухшие записи, затем — самые старые
+                for k in [k for k, (exp, _) in self._data.items() if exp <= now]:
+                    del self._data[k]
+                while len(self._data) >= self._maxsize:
+                    del self._data[next(iter(self._data))]
+            self._data[key] = (now + ttl, value)
+
+    def invalidate(self, prefix):
+        """Удаляет все записи, ключ которых начинается с кортежа prefix."""
+        n = len(prefix)
+        with self._lock:
+            for key in [k for k in self._data if k[:n] == prefix]:
+                self._data.pop(key, None)
+
+
+API_CACHE = TTLCache()
+
+
+def ttl_cache(ttl):
+    """Декоратор: кеширует результат функции по её имени и позиционным аргументам."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = (func.__name__,) + args
+            hit, value = API_CACHE.get(key)
+            if hit:
+                return value
+            value = func(*args)
+            API_CACHE.set(key, value, ttl)
+            return value
+        return wrapper
+    return decorator
+
+
+def cache_invalidate(name, *args):
+    """
+    Сбрасывает кеш функции name (целиком или только для указанных аргументов),
+    например cache_invalidate("yg_get_columns", board_id).
+    """
+    API_CACHE.invalidate((name,) + args)
+
+
 # ---------------------------------------------------------------------------
 #  Состояние диалогов (по пользователю и корневому посту)
 # ---------------------------------------------------------------------------
 
-# ключ: (user_id, root_post_id) → dict со всеми шагами мастера
-STATE = defaultdict(dict)
-STATE_LOCK = threading.Lock()
+# ключ: (user_id, root_post_id) → dict со всеми шагами мастера.
+# Состояние разбито на STATE_SHARDS_COUNT шардов, у каждого свой лок,
+# чтобы шаги разных диалогов не ждали друг друга.
+# Каждый шард — OrderedDict, работающий как LRU: последние изменённые диалоги — в конце.
+STATE_SHARDS_COUNT = 16
+STATE_SHARDS = [OrderedDict() for _ in range(STATE_SHARDS_COUNT)]
+STATE_LOCKS = [threading.Lock() for _ in range(STATE_SHARDS_COUNT)]
+
+# Ограничения на размер STATE: не больше STATE_MAX_ENTRIES диалогов (поровну на шард),
+# и диалоги без активности дольше STATE_TTL_SECONDS удаляются авто-уборкой.
+STATE_MAX_ENTRIES = 10_000
+STATE_SHARD_MAX_ENTRIES = max(1, STATE_MAX_ENTRIES // STATE_SHARDS_COUNT)
+STATE_TTL_SECONDS = AUTO_FINISH_TIMEOUT_MINUTES * 2 * 60
 
 # ---------------------------------------------------------------------------
 #  Мэппинг: канал Loop (Mattermost) → проект YouGile по умолчанию
@@ -109,6 +503,12 @@ CHANNEL_MAP_FILE = os.getenv("CHANNEL_MAP_FILE", "/data/channel_project_map.json
 CHANNEL_MAP_LOCK = threading.Lock()
 CHANNEL_PROJECT_MAP = {}  # channel_id -> {"project_id": ..., "project_title": ...}
 
+# Запись файла отложенная: изменения помечают мэппинг "грязным",
+# а фоновый поток сбрасывает его на диск не чаще раза в CHANNEL_MAP_FLUSH_DELAY секунд.
+CHANNEL_MAP_FLUSH_DELAY = 1.0
+CHANNEL_MAP_DIRTY = threading.Event()
+CHANNEL_MAP_WRITE_LOCK = threading.Lock()
+
 
 def load_channel_map():
     """Загружает соответствие канал → проект по умолчанию из JSON-файла."""
@@ -121,31 +521,48 @@ def load_channel_map():
             CHANNEL_PROJECT_MAP = json.load(f)
     except FileNotFoundError:
         CHANNEL_PROJECT_MAP = {}
-    except Exception as e:
-        print("Error loading channel map:", e)
+    except Exception:
+        logger.exception("Error loading channel map")
         CHANNEL_PROJECT_MAP = {}
 
 
-def save_channel_map():
-    """Сохраняет соответствие канал → проект по умолчанию в JSON-файл."""
+def write_channel_map(snapshot):
+    """Атомарно записывает снимок мэппинга канал → проект в JSON-файл."""
     if not CHANNEL_MAP_FILE:
         return
     tmp_path = CHANNEL_MAP_FILE + ".tmp"
-    try:
-        with open(tmp_path, "w", encoding="utf-8") as f:
-            json.dump(CHANNEL_PROJECT_MAP, f, ensure_ascii=False, indent=2)
-        os.replace(tmp_path, CHANNEL_MAP_FILE)
-    except Exception as e:
-        print("Error saving channel map:", e)
+    with CHANNEL_MAP_WRITE_LOCK:
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, CHANNEL_MAP_FILE)
+        except Exception:
+            logger.exception("Error saving channel map")
+
+
+def flush_channel_map():
+    """Сбрасывает мэппинг на диск, если с прошлой записи были изменения."""
+    with CHANNEL_MAP_LOCK:
+        if not CHANNEL_MAP_DIRTY.is_set():
+            return
+        snapshot = dict(CHANNEL_PROJECT_MAP)
+        CHANNEL_MAP_DIRTY.clear()
+    write_channel_map(snapshot)
+
+
+def save_channel_map():
+    """
+    Помечает мэппинг изменённым. Сама запись в файл выполняется
+    фоновым потоком (channel_map_flush_loop) или при завершении процесса.
+    """
+    CHANNEL_MAP_DIRTY.set()
 
 
 def get_default_project_for_channel(channel_id):
     """Возвращает запись о проекте по умолчанию для канала (или None)."""
-    with CHANNEL_MAP_LOCK:
-        entry = CHANNEL_PROJECT_MAP.get(channel_id)
-        if not entry:
-            return None
-        return entry  # {"project_id": ..., "project_title": ...}
+    # Без лока: записи не меняются на месте, set/delete только заменяют их целиком,
+    # а одиночный dict.get атомарен. Лок нужен лишь писателям и снимку для файла.
+    return CHANNEL_PROJECT_MAP.get(channel_id) or None  # {"project_id": ..., "project_title": ...}
 
 
 def set_default_project_for_channel(channel_id, project_id, project_title):
@@ -166,31 +583,79 @@ def delete_default_project_for_channel(channel_id):
             save_channel_map()
 
 
+def state_shard(key):
+    """Возвращает (шард, лок шарда) для ключа (user_id, root_post_id)."""
+    i = hash(key) % STATE_SHARDS_COUNT
+    return STATE_SHARDS[i], STATE_LOCKS[i]
+
+
+def touch_state_locked(shard, key):
+    """
+    Помечает диалог как самый свежий в шарде и вытесняет самые старые,
+    если шард превысил STATE_SHARD_MAX_ENTRIES. Вызывать под локом шарда.
+    """
+    shard.move_to_end(key)
+    while len(shard) > STATE_SHARD_MAX_ENTRIES:
+        shard.popitem(last=False)
+
+
 def set_state(user_id, root_post_id, data: dict):
     """
     Обновляет состояние мастера для пары (user_id, root_post_id).
     Заодно проставляет created_at / updated_at.
     """
     now = time.time()
-    with STATE_LOCK:
-        s = STATE[(user_id, root_post_id)]
+    key = (user_id, root_post_id)
+    shard, lock = state_shard(key)
+    with lock:
+        s = shard.get(key)
+        if s is None:
+            s = shard[key] = {}
         if "created_at" not in s:
             s["created_at"] = now
         s.update(data or {})
         s["updated_at"] = now
+        touch_state_locked(shard, key)
+        return s
+
+
+def replace_state(user_id, root_post_id, data: dict):
+    """Заменяет состояние мастера целиком (начало нового диалога)."""
+    now = time.time()
+    key = (user_id, root_post_id)
+    shard, lock = state_shard(key)
+    with lock:
+        s = shard[key] = dict(data, created_at=now, updated_at=now)
+        touch_state_locked(shard, key)
         return s
 
 
 def get_state(user_id, root_post_id):
     """Возвращает состояние мастера, если есть, иначе None."""
-    with STATE_LOCK:
-        return STATE.get((user_id, root_post_id))
+    key = (user_id, root_post_id)
+    shard, lock = state_shard(key)
+    with lock:
+        return shard.get(key)
 
 
 def clear_state(user_id, root_post_id):
     """Удаляет состояние мастера для пары (user_id, root_post_id)."""
-    with STATE_LOCK:
-        STATE.pop((user_id, root_post_id), None)
+    key = (user_id, root_post_id)
+    shard, lock = state_shard(key)
+    with lock:
+        shard.pop(key, None)
+
+
+def reap_stale_states(now):
+    """Удаляет диалоги, в которых не было активности дольше STATE_TTL_SECONDS."""
+    reaped = 0
+    for shard, lock in zip(STATE_SHARDS, STATE_LOCKS):
+        with lock:
+            # самые старые диалоги — в начале шарда
+            while shard and now - next(iter(shard.values()))["updated_at"] > STATE_TTL_SECONDS:
+                shard.popitem(last=False)
+                reaped += 1
+    return reaped
 
 
 # ---------------------------------------------------------------------------
@@ -199,39 +664,57 @@ def clear_state(user_id, root_post_id):
 
 def mm_get_me():
     """Получить данные текущего пользователя (бота) по токену."""
-    r = requests.get(f"{MM_URL}/api/v4/users/me", headers=mm_headers, timeout=10)
+    r = mm_session.get(MM_USERS_ME_URL, timeout=HTTP_TIMEOUT)
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
 
 
-def get_bot_user_id():
-    """Лениво получить и закешировать user_id бота."""
+def refresh_bot_user_id():
+    """
+    Запрашивает и запоминает user_id бота.
+    Под локом, чтобы при пачке событий не было нескольких одновременных запросов /users/me.
+    """
     global BOT_USER_ID
-    if BOT_USER_ID:
+    with BOT_USER_ID_LOCK:
+        if BOT_USER_ID:
+            return BOT_USER_ID
+        try:
+            BOT_USER_ID = mm_get_me().get("id")
+        except Exception:
+            logger.exception("Error getting bot user id")
+            BOT_USER_ID = None
         return BOT_USER_ID
-    try:
-        me = mm_get_me()
-        BOT_USER_ID = me.get("id")
-    except Exception as e:
-        print("Error getting bot user id:", e)
-        BOT_USER_ID = None
-    return BOT_USER_ID
 
 
+def get_bot_user_id():
+    """user_id бота; если при старте получить его не удалось — пробуем ещё раз."""
+    return BOT_USER_ID or refresh_bot_user_id()
+
+
+@ttl_cache(MM_USERS_TTL)
 def mm_get_user(user_id):
     """Получить данные пользователя по user_id."""
-    url = f"{MM_URL}/api/v4/users/{user_id}"
-    r = requests.get(url, headers=mm_headers, timeout=10)
+    url = f"{MM_USERS_URL}/{user_id}"
+    r = mm_session.get(url, timeout=HTTP_TIMEOUT)
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
+
 
+def mm_user_names(mm_user):
+    """(полное имя, username) пользователя Loop; если имя не заполнено — вместо него username."""
+    first_name = (mm_user.get("first_name") or "").strip()
+    last_name = (mm_user.get("last_name") or "").strip()
+    username = mm_user.get("username") or ""
+    return (first_name + " " + last_name).strip() or username, username
 
+
+@ttl_cache(MM_CHANNELS_TTL)
 def mm_get_channel(channel_id):
     """Получить данные канала (для красивого имени чата)."""
-    url = f"{MM_URL}/api/v4/channels/{channel_id}"
-    r = requests.get(url, headers=mm_headers, timeout=10)
+    url = f"{MM_CHANNELS_URL}/{channel_id}"
+    r = mm_session.get(url, timeout=HTTP_TIMEOUT)
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
 
 
 def mm_post(channel_id, message, attachments=None, root_id=None):
@@ -250,9 +733,9 @@ def mm_post(channel_id, message, attachments=None, root_id=None):
         payload.setdefault("props", {})
         payload["props"]["attachments"] = attachments
 
-    r = requests.post(f"{MM_URL}/api/v4/posts", headers=mm_headers, json=payload, timeout=10)
+    r = mm_session.post(MM_POSTS_URL, data=json_dumps(payload), timeout=HTTP_TIMEOUT)
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
 
 
 def mm_patch_post(post_id, message=None, attachments=None):
@@ -268,9 +751,22 @@ def mm_patch_post(post_id, message=None, attachments=None):
         payload.setdefault("props", {})
         payload["props"]["attachments"] = attachments
 
-    r = requests.put(f"{MM_URL}/api/v4/posts/{post_id}", headers=mm_headers, json=payload, timeout=10)
+    r = mm_session.put(f"{MM_POSTS_URL}/{post_id}", data=json_dumps(payload), timeout=HTTP_TIMEOUT)
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
+
+
+def mm_delete_post(post_id):
+    """Удаляет пост. Ошибки только логируются: служебное сообщение можно и не удалить."""
+    try:
+        mm_session.delete(f"{MM_POSTS_URL}/{post_id}", timeout=(HTTP_CONNECT_TIMEOUT, 5))
+    except Exception:
+        logger.exception("Error deleting post %s", post_id)
+
+
+def mm_delete_posts(post_ids):
+    """Удаляет несколько постов параллельно (через IO_POOL) и ждёт, пока удалятся все."""
+    list(IO_POOL.map(mm_delete_post, post_ids))
 
 
 def mm_post_ephemeral(user_id, channel_id, message, attachments=None, root_id=None):
@@ -294,14 +790,13 @@ def mm_post_ephemeral(user_id, channel_id, message, attachments=None, root_id=No
         "post": post,
     }
 
-    r = requests.post(
-        f"{MM_URL}/api/v4/posts/ephemeral",
-        headers=mm_headers,
-        json=payload,
-        timeout=10,
+    r = mm_session.post(
+        MM_EPHEMERAL_POSTS_URL,
+        data=json_dumps(payload),
+        timeout=HTTP_TIMEOUT,
     )
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
 
 
 def mm_add_reaction(user_id, post_id, emoji_name):
@@ -315,36 +810,51 @@ def mm_add_reaction(user_id, post_id, emoji_name):
         "post_id": post_id,
         "emoji_name": emoji_name,
     }
-    r = requests.post(
-        f"{MM_URL}/api/v4/reactions",
-        headers=mm_headers,
-        json=payload,
-        timeout=10,
+    r = mm_session.post(
+        MM_REACTIONS_URL,
+        data=json_dumps(payload),
+        timeout=HTTP_TIMEOUT,
     )
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
 
 
 def mm_get_file(file_id):
     """Скачать файл из Loop по file_id."""
-    r = requests.get(
-        f"{MM_URL}/api/v4/files/{file_id}",
-        headers=mm_headers,
-        timeout=30,
+    r = mm_session.get(
+        f"{MM_FILES_URL}/{file_id}",
+        timeout=UPLOAD_TIMEOUT,
     )
     r.raise_for_status()
     return r.content
 
 
+def mm_open_file(file_id):
+    """
+    Открыть файл из Loop потоком (stream=True), не загружая его в память.
+    Возвращает Response — использовать как контекстный менеджер.
+    """
+    r = mm_session.get(
+        f"{MM_FILES_URL}/{file_id}",
+        stream=True,
+        timeout=UPLOAD_TIMEOUT,
+    )
+    try:
+        r.raise_for_status()
+    except Exception:
+        r.close()
+        raise
+    return r
+
+
 def mm_get_file_info(file_id):
     """Получить метаданные файла из Loop (имя, mime и т.п.)."""
-    r = requests.get(
-        f"{MM_URL}/api/v4/files/{file_id}/info",
-        headers=mm_headers,
-        timeout=10,
+    r = mm_session.get(
+        f"{MM_FILES_URL}/{file_id}/info",
+        timeout=HTTP_TIMEOUT,
     )
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
 
 
 def decode_mm_post_from_event(data):
@@ -352,7 +862,12 @@ def decode_mm_post_from_event(data):
     post_raw = data.get("data", {}).get("post")
     if not post_raw:
         return None
-    return json.loads(post_raw)
+    return json_loads(post_raw)
+
+
+# Упоминание бота и быстрая команда — собираются один раз при импорте
+BOT_MENTION_RE = re.compile(rf"@{re.escape(MM_BOT_USERNAME)}", re.IGNORECASE)
+CREATE_COMMAND_RE = re.compile(r"^создай\s+задачу\s+(.+)$", re.IGNORECASE)
 
 
 def parse_create_command(message: str, bot_username: str):
@@ -362,14 +877,16 @@ def parse_create_command(message: str, bot_username: str):
 
     Возвращает title задачи или None, если формат не подходит.
     """
-    text = message.strip()
+    if bot_username == MM_BOT_USERNAME:
+        mention_re = BOT_MENTION_RE
+    else:
+        mention_re = re.compile(rf"@{re.escape(bot_username)}", re.IGNORECASE)
+
     # Убираем упоминание бота
-    mention_pattern = rf"@{re.escape(bot_username)}"
-    text = re.sub(mention_pattern, "", text, flags=re.IGNORECASE).strip()
+    text = mention_re.sub("", message.strip()).strip()
 
     # Ищем "создай задачу ..."
-    pattern = r"^создай\s+задачу\s+(.+)$"
-    m = re.search(pattern, text, flags=re.IGNORECASE)
+    m = CREATE_COMMAND_RE.match(text)
     if not m:
         return None
     return m.group(1).strip()
@@ -395,40 +912,46 @@ def extract_selected_value(data):
 #  Обёртки над YouGile API (проекты / доски / задачи / чат / файлы)
 # ---------------------------------------------------------------------------
 
+@ttl_cache(YG_PROJECTS_TTL)
+@guarded_by(YG_BREAKER)
 def yg_get_projects():
     """GET /projects — список проектов компании в YouGile."""
-    r = requests.get(f"{YOUGILE_BASE_URL}/projects", headers=yg_headers, timeout=10)
+    r = yg_session.get(YG_PROJECTS_URL, timeout=HTTP_TIMEOUT)
     r.raise_for_status()
-    data = r.json()
+    data = json_loads(r.content)
     return data.get("content", [])
 
 
+@ttl_cache(YG_BOARDS_TTL)
+@guarded_by(YG_BREAKER)
 def yg_get_boards(project_id):
     """GET /boards?projectId=... — список досок проекта."""
-    r = requests.get(
-        f"{YOUGILE_BASE_URL}/boards",
-        headers=yg_headers,
+    r = yg_session.get(
+        YG_BOARDS_URL,
         params={"projectId": project_id},
-        timeout=10
+        timeout=HTTP_TIMEOUT
     )
     r.raise_for_status()
-    data = r.json()
+    data = json_loads(r.content)
     return data.get("content", [])
 
 
+@ttl_cache(YG_COLUMNS_TTL)
+@guarded_by(YG_BREAKER)
 def yg_get_columns(board_id):
     """GET /columns?boardId=... — список колонок доски."""
-    r = requests.get(
-        f"{YOUGILE_BASE_URL}/columns",
-        headers=yg_headers,
+    r = yg_session.get(
+        YG_COLUMNS_URL,
         params={"boardId": board_id},
-        timeout=10
+        timeout=HTTP_TIMEOUT
     )
     r.raise_for_status()
-    data = r.json()
+    data = json_loads(r.content)
     return data.get("content", [])
 
 
+@ttl_cache(YG_USERS_TTL)
+@guarded_by(YG_BREAKER)
 def yg_get_project_users(project_id=None):
     """
     GET /users?projectId=... — список пользователей проекта
@@ -436,14 +959,13 @@ def yg_get_project_users(project_id=None):
     """
     params = {"projectId": project_id} if project_id else None
 
-    r = requests.get(
-        f"{YOUGILE_BASE_URL}/users",
-        headers=yg_headers,
+    r = yg_session.get(
+        YG_USERS_URL,
         params=params,
-        timeout=10
+        timeout=HTTP_TIMEOUT
     )
     r.raise_for_status()
-    data = r.json()
+    data = json_loads(r.content)
 
     if isinstance(data, dict):
         return data.get("content", [])
@@ -454,6 +976,17 @@ def yg_get_project_users(project_id=None):
     return []
 
 
+@ttl_cache(YG_USERS_TTL)
+def yg_get_project_users_by_id(project_id=None):
+    """Индекс id -> пользователь поверх закешированного yg_get_project_users."""
+    return {u.get("id"): u for u in yg_get_project_users(project_id)}
+
+
+# Порядковый номер 1970-01-01 — для перевода date в миллисекунды epoch без datetime
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+@guarded_by(YG_BREAKER)
 def yg_create_task(title, column_id, description="", assignee_id=None, deadline=None):
     """
     POST /tasks — создать задачу в YouGile.
@@ -476,40 +1009,33 @@ def yg_create_task(title, column_id, description="", assignee_id=None, deadline=
     # дедлайн в формате YouGile
     if deadline:
         # deadline у нас date, превращаем в полдень по UTC, чтобы дата не сдвигалась
-        dt_utc_noon = datetime(
-            deadline.year,
-            deadline.month,
-            deadline.day,
-            12, 0, 0,
-            tzinfo=timezone.utc,
-        )
-        ms = int(dt_utc_noon.timestamp() * 1000)
+        ms = ((deadline.toordinal() - EPOCH_ORDINAL) * 86400 + 12 * 3600) * 1000
         body["deadline"] = {
             "deadline": ms,
             "withTime": False,
         }
 
-    r = requests.post(
-        f"{YOUGILE_BASE_URL}/tasks",
-        headers=yg_headers,
-        json=body,
-        timeout=10,
+    r = yg_session.post(
+        YG_TASKS_URL,
+        data=json_dumps(body),
+        timeout=HTTP_TIMEOUT,
     )
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
 
 
+@guarded_by(YG_BREAKER)
 def yg_get_task(task_id):
     """GET /tasks/{id} — полная карточка задачи (для получения idTaskProject/idTaskCommon, если нужно)."""
-    r = requests.get(
-        f"{YOUGILE_BASE_URL}/tasks/{task_id}",
-        headers=yg_headers,
-        timeout=10,
+    r = yg_session.get(
+        f"{YG_TASKS_URL}/{task_id}",
+        timeout=HTTP_TIMEOUT,
     )
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
 
 
+@guarded_by(YG_BREAKER)
 def yg_send_chat_message(chat_id, text):
     """
     Отправить сообщение в чат задачи.
@@ -521,55 +1047,80 @@ def yg_send_chat_message(chat_id, text):
         "text": text,
     }
 
-    url = f"{YOUGILE_BASE_URL}/chats/{chat_id}/messages"
+    url = f"{YG_CHATS_URL}/{chat_id}/messages"
 
-    r = requests.post(
+    r = yg_session.post(
         url,
-        headers=yg_headers,
-        json=payload,
-        timeout=10,
+        data=json_dumps(payload),
+        timeout=HTTP_TIMEOUT,
     )
 
     if "application/json" not in r.headers.get("Content-Type", ""):
         # Редкий случай: YouGile вернул что-то не JSON — просто логируем
-        print("YG chat send non-JSON response:", r.status_code, r.text[:500])
+        logger.warning("YG chat send non-JSON response: %s %s", r.status_code, r.text[:500])
 
     r.raise_for_status()
     try:
-        return r.json()
+        return json_loads(r.content)
     except ValueError:
         return {}
 
 
-def yg_upload_file(file_bytes, filename, mimetype="application/octet-stream"):
+# Размер чанка при потоковой пересылке файла Loop → YouGile
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class SourceStreamError(Exception):
+    """
+    Не удалось дочитать файл из Loop во время потоковой загрузки в YouGile.
+    Не наследуется от requests.RequestException, чтобы сбой Loop не засчитывался
+    предохранителю YouGile (guarded_by учитывает только исключения requests).
     """
-    Загрузить файл в YouGile и вернуть относительный URL вида
-    /user-data/.../file.ext
 
-    POST /api-v2/upload-file (multipart/form-data).
+
+class MultipartFileStream:
     """
-    files = {
-        "file": (filename, file_bytes, mimetype),
-    }
+    Тело multipart/form-data с единственным полем "file", которое отдаётся
+    чанками из итератора, а не собирается целиком в памяти.
 
-    # Для multipart заголовок Content-Type ставит сам requests,
-    # поэтому убираем его из yg_headers
-    headers = dict(yg_headers)
-    headers.pop("Content-Type", None)
+    Размер файла известен заранее, поэтому __len__ даёт точный Content-Length
+    и requests отправляет тело без chunked-кодирования.
+    """
+
+    def __init__(self, chunks, size, filename, mimetype):
+        self.boundary = uuid.uuid4().hex
+        field = RequestField(name="file", data=b"", filename=filename)
+        field.make_multipart(content_type=mimetype)
+        self.head = f"--{self.boundary}\r\n".encode() + field.render_headers().encode("utf-8")
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self.chunks = chunks
+        self.size = size
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        try:
+            yield from self.chunks
+        except Exception as e:
+            # ошибка на стороне Loop (обрыв, таймаут чтения), а не YouGile
+            raise SourceStreamError(f"Error reading file from Loop: {e}") from e
+        yield self.tail
 
-    r = requests.post(
-        f"{YOUGILE_BASE_URL}/upload-file",
-        headers=headers,
-        files=files,
-        timeout=30,
-    )
 
+def parse_yg_upload_response(r):
+    """Разбирает ответ POST /upload-file и возвращает URL загруженного файла."""
     if "application/json" not in r.headers.get("Content-Type", ""):
-        print("YG upload non-JSON response:", r.status_code, r.text[:500])
+        logger.warning("YG upload non-JSON response: %s %s", r.status_code, r.text[:500])
     r.raise_for_status()
 
     try:
-        data = r.json()
+        data = json_loads(r.content)
     except ValueError:
         raise RuntimeError(
             f"YouGile file upload returned non-JSON response (status {r.status_code})"
@@ -581,39 +1132,91 @@ def yg_upload_file(file_bytes, filename, mimetype="application/octet-stream"):
         or data.get("fileUrl")
     )
     if not file_url:
-        print("YG upload unexpected JSON:", data)
+        logger.warning("YG upload unexpected JSON: %s", data)
         raise RuntimeError("YouGile file upload JSON has no 'url' field")
 
     return file_url
 
 
-def get_allowed_projects_for_mm_user(user_id):
+@guarded_by(YG_BREAKER)
+def yg_upload_file(file_bytes, filename, mimetype="application/octet-stream"):
     """
-    Возвращает список проектов YouGile, к которым у пользователя Loop есть доступ (по email).
+    Загрузить файл в YouGile и вернуть относительный URL вида
+    /user-data/.../file.ext
 
-    Логика:
-    1) Берём email пользователя из Loop.
-    2) Один запрос к /users (все пользователи компании) -> строим map user_id -> email.
-    3) Один запрос к /projects -> в каждом проекте поле "users" (userId -> role).
-    4) Для каждого проекта проверяем, есть ли среди users тот, у кого email = email из Loop.
+    POST /api-v2/upload-file (multipart/form-data).
     """
-    try:
-        mm_user = mm_get_user(user_id)
-        mm_email = (mm_user.get("email") or "").strip().lower()
-    except Exception as e:
-        print("Error fetching MM user for project filter:", e)
-        mm_email = ""
+    files = {
+        "file": (filename, file_bytes, mimetype),
+    }
 
-    if not mm_email:
-        return []
+    # Для multipart заголовок Content-Type ставит сам requests,
+    # поэтому убираем сессионный JSON Content-Type (None = удалить заголовок)
+    r = yg_session.post(
+        YG_UPLOAD_FILE_URL,
+        headers={"Content-Type": None},
+        files=files,
+        timeout=UPLOAD_TIMEOUT,
+    )
+    return parse_yg_upload_response(r)
 
-    # 1) Все пользователи компании: id -> email
-    try:
-        all_users = yg_get_project_users(None)  # вызов без projectId -> /users (все пользователи)
-    except Exception as e:
-        print("Error fetching YouGile users:", e)
-        all_users = []
 
+@guarded_by(YG_BREAKER)
+def yg_upload_file_stream(chunks, size, filename, mimetype="application/octet-stream"):
+    """
+    То же, что yg_upload_file, но содержимое файла (size байт) берётся
+    из итератора chunks и передаётся в YouGile потоком.
+    """
+    body = MultipartFileStream(chunks, size, filename, mimetype)
+    r = yg_session.post(
+        YG_UPLOAD_FILE_URL,
+        headers={"Content-Type": body.content_type},
+        data=body,
+        timeout=UPLOAD_TIMEOUT,
+    )
+    return parse_yg_upload_response(r)
+
+
+def upload_mm_file_to_yougile(file_id, info=None):
+    """
+    Переносит файл из Loop в YouGile и возвращает URL файла в YouGile.
+    info — метаданные файла, если они уже есть (из metadata.files поста); иначе запрашиваются.
+    Если размер файла известен — скачивание и загрузка идут потоком,
+    без буферизации всего файла в памяти.
+    """
+    if info is None:
+        info = mm_get_file_info(file_id)
+    filename = info.get("name") or info.get("id") or "file"
+    mimetype = info.get("mime_type") or "application/octet-stream"
+    size = info.get("size")
+
+    if not isinstance(size, int) or size < 0:
+        return yg_upload_file(mm_get_file(file_id), filename, mimetype)
+
+    with mm_open_file(file_id) as resp:
+        chunks = resp.iter_content(chunk_size=UPLOAD_CHUNK_SIZE)
+        return yg_upload_file_stream(chunks, size, filename, mimetype)
+
+
+# ---------------------------------------------------------------------------
+#  Индекс доступа: email → проекты YouGile, в которых состоит пользователь с этим email
+# ---------------------------------------------------------------------------
+
+# Индекс общий для всех пользователей Loop и перестраивается не чаще раза в YG_INDEX_TTL секунд
+YG_INDEX_TTL = 10 * 60
+# Принудительная пересборка (пользователь не найден) — не чаще раза в YG_INDEX_MIN_AGE секунд
+YG_INDEX_MIN_AGE = 30
+YG_INDEX_LOCK = threading.Lock()
+YG_PROJECTS_BY_EMAIL = {}  # email -> [project, ...]
+YG_INDEX_BUILT_AT = None   # time.monotonic() последней успешной сборки
+
+
+def build_projects_by_email(all_users, all_projects):
+    """
+    Строит индекс email -> список проектов:
+    1) по /users — map user_id -> email,
+    2) по /projects — в каждом проекте поле "users" (userId -> role).
+    """
     user_email_by_id = {}
     for u in all_users:
         uid = u.get("id")
@@ -621,15 +1224,7 @@ def get_allowed_projects_for_mm_user(user_id):
         if uid and email:
             user_email_by_id[uid] = email
 
-    # 2) Все проекты
-    try:
-        all_projects = yg_get_projects()
-    except Exception as e:
-        print("Error fetching YouGile projects:", e)
-        all_projects = []
-
-    allowed_projects = []
-
+    projects_by_email = {}
     for p in all_projects:
         # Можно сразу отфильтровать удалённые проекты
         if p.get("deleted"):
@@ -640,96 +1235,201 @@ def get_allowed_projects_for_mm_user(user_id):
             continue
 
         # users_map: { userId: "roleId" / "worker" / ... }
-        for user_id_in_project in users_map.keys():
-            email = user_email_by_id.get(user_id_in_project)
-            if email and email == mm_email:
-                allowed_projects.append(p)
-                break  # этот проект уже добавлен, дальше юзеров не смотрим
-
-    return allowed_projects
+        emails = {user_email_by_id[uid] for uid in users_map if uid in user_email_by_id}
+        for email in emails:
+            projects_by_email.setdefault(email, []).append(p)
 
+    return projects_by_email
 
-# ---------------------------------------------------------------------------
-#  Дедлайны
-# ---------------------------------------------------------------------------
 
-def calc_deadline(choice: str) -> date:
+def refresh_yg_index():
     """
-    Преобразует строковый выбор дедлайна в дату:
-    today / tomorrow / day_after_tomorrow / week / month.
+    Перестраивает индекс email -> проекты по свежим данным YouGile.
+    Запросы пользователей и проектов независимы и выполняются параллельно в IO_POOL.
+    При ошибке оставляет прежний индекс — следующий вызов попробует ещё раз.
     """
-    today = date.today()
-    c = (choice or "").lower()
-    if c == "today":
-        return today
-    if c == "tomorrow":
-        return today + timedelta(days=1)
-    if c == "day_after_tomorrow":
-        return today + timedelta(days=2)
-    if c == "week":
-        return today + timedelta(days=7)
-    if c == "month":
-        return today + timedelta(days=30)
-    # fallback: сегодня
-    return today
+    global YG_PROJECTS_BY_EMAIL, YG_INDEX_BUILT_AT
 
+    # индекс сам задаёт свежесть данных, поэтому ответы берём мимо TTL-кеша
+    cache_invalidate("yg_get_projects")
+    cache_invalidate("yg_get_project_users", None)
 
-def format_deadline(choice: str, deadline: date | None, raw_display: str | None = None):
+    # вызов без projectId -> /users (все пользователи)
+    f_all_users = IO_POOL.submit(yg_get_project_users, None)
+    f_all_projects = IO_POOL.submit(yg_get_projects)
+    try:
+        all_users = f_all_users.result()
+        all_projects = f_all_projects.result()
+    except Exception:
+        logger.exception("Error refreshing YouGile access index")
+        return
+
+    YG_PROJECTS_BY_EMAIL = build_projects_by_email(all_users, all_projects)
+    YG_INDEX_BUILT_AT = time.monotonic()
+
+
+def warm_up_yg_index():
     """
-    Преобразует внутренние значения дедлайна в:
-    - deadline_human: человекочитаемое значение ("Сегодня", "Через неделю", "Без дедлайна", "2025-11-13", ...)
-    - deadline_str: финальная строка для summary, вида "<human> (DD.MM.YYYY)" или "без дедлайна"
+    Строит индекс доступа при старте, не дожидаясь первого упоминания бота.
+    Заодно открывает keep-alive соединения пула yg_session к YouGile.
     """
-    choice = (choice or "").lower()
+    with YG_INDEX_LOCK:
+        if YG_INDEX_BUILT_AT is None:
+            refresh_yg_index()
 
-    if choice == "none":
-        deadline_human = "Без дедлайна"
-    elif choice == "today":
-        deadline_human = "Сегодня"
-    elif choice == "tomorrow":
-        deadline_human = "Завтра"
-    elif choice == "day_after_tomorrow":
-        deadline_human = "Послезавтра"
-    elif choice == "week":
-        deadline_human = "Через неделю"
-    elif choice == "month":
-        deadline_human = "Через месяц"
-    elif choice == "custom" and raw_display:
-        # Показываем ровно то, что ввёл пользователь
-        deadline_human = raw_display
-    elif deadline:
-        deadline_human = deadline.strftime("%d.%m.%Y")
-    else:
-        deadline_human = "без дедлайна"
 
-    if deadline:
-        date_str = deadline.strftime("%d.%m.%Y")
-        deadline_str = f"{deadline_human} ({date_str})"
-    else:
-        deadline_str = deadline_human or "без дедлайна"
+def start_yg_warm_up_thread():
+    """Стартует фоновый прогрев индекса доступа и соединений к YouGile."""
+    t = threading.Thread(target=warm_up_yg_index, daemon=True)
+    t.start()
 
-    return deadline_human, deadline_str
 
+def yg_index_is_fresh(max_age):
+    """Индекс доступа построен не раньше, чем max_age секунд назад."""
+    built_at = YG_INDEX_BUILT_AT
+    return built_at is not None and time.monotonic() - built_at <= max_age
 
-# ---------------------------------------------------------------------------
-#  Построение интерактивных сообщений (attachments) для шагов мастера
-# ---------------------------------------------------------------------------
 
-def build_task_summary(task_title, project_title, board_title, assignee_name, deadline_str, task_url=None):
+def get_projects_for_email(email, *, force_refresh=False):
     """
-    Строит единообразное summary задачи:
-    Задача "<title>" создана в проекте: <project>, доска: <board>,
-    ответственный: <assignee>, дедлайн: <deadline>.
-    При наличии добавляет ссылку.
+    Проекты YouGile пользователя с указанным email (по индексу, при необходимости обновив его).
+    Свежий индекс читается без блокировки; перестраивает его только один поток,
+    остальные ждут на YG_INDEX_LOCK и берут готовый результат.
     """
-    summary = (
-        f'Задача "{task_title}" создана в проекте: {project_title}, '
-        f'доска: {board_title}, ответственный: {assignee_name}, '
-        f'дедлайн: {deadline_str}.'
-    )
-    if task_url:
-        summary += f"\nСсылка: {task_url}"
-    return summary
+    max_age = YG_INDEX_MIN_AGE if force_refresh else YG_INDEX_TTL
+    if not yg_index_is_fresh(max_age):
+        with YG_INDEX_LOCK:
+            # пока ждали блокировку, индекс мог перестроить другой поток
+            if not yg_index_is_fresh(max_age):
+                refresh_yg_index()
+    return list(YG_PROJECTS_BY_EMAIL.get(email, []))
+
+
+def get_allowed_projects_for_mm_user(user_id):
+    """
+    Возвращает список проектов YouGile, к которым у пользователя Loop есть доступ (по email).
+
+    Логика:
+    1) Берём email пользователя из Loop.
+    2) Ищем его в индексе email -> проекты (см. refresh_yg_index).
+    """
+    try:
+        mm_user = mm_get_user(user_id)
+        mm_email = (mm_user.get("email") or "").strip().lower()
+    except Exception:
+        logger.exception("Error fetching MM user for project filter")
+        mm_email = ""
+
+    if not mm_email:
+        return []
+
+    allowed_projects = get_projects_for_email(mm_email)
+    if not allowed_projects:
+        # Пользователя могли только что добавить в проект — не заставляем ждать истечения TTL
+        allowed_projects = get_projects_for_email(mm_email, force_refresh=True)
+
+    return allowed_projects
+
+
+# ---------------------------------------------------------------------------
+#  Дедлайны
+# ---------------------------------------------------------------------------
+
+# Выбор дедлайна → смещение от сегодняшней даты
+DEADLINE_OFFSETS = {
+    "today": timedelta(days=0),
+    "tomorrow": timedelta(days=1),
+    "day_after_tomorrow": timedelta(days=2),
+    "week": timedelta(days=7),
+    "month": timedelta(days=30),
+}
+
+# Выбор дедлайна → человекочитаемая подпись
+DEADLINE_LABELS = {
+    "none": "Без дедлайна",
+    "today": "Сегодня",
+    "tomorrow": "Завтра",
+    "day_after_tomorrow": "Послезавтра",
+    "week": "Через неделю",
+    "month": "Через месяц",
+}
+
+
+def calc_deadline(choice: str) -> date:
+    """
+    Преобразует строковый выбор дедлайна в дату:
+    today / tomorrow / day_after_tomorrow / week / month.
+    """
+    # fallback: сегодня
+    offset = DEADLINE_OFFSETS.get((choice or "").lower(), DEADLINE_OFFSETS["today"])
+    return date.today() + offset
+
+
+# Пользователи часто вводят одну и ту же дату повторно
+@functools.lru_cache(maxsize=128)
+def parse_deadline_date(text: str) -> date:
+    """
+    Разбирает дату YYYY-MM-DD, введённую пользователем (как strptime "%Y-%m-%d":
+    год — 4 цифры, месяц и день — 1–2 цифры). При ошибке — ValueError.
+    """
+    parts = text.split("-")
+    if len(parts) != 3:
+        raise ValueError(f"bad date: {text!r}")
+    y, m, d = parts
+    if not (
+        len(y) == 4 and 1 <= len(m) <= 2 and 1 <= len(d) <= 2
+        and (y + m + d).isascii() and (y + m + d).isdigit()
+    ):
+        raise ValueError(f"bad date: {text!r}")
+    return date(int(y), int(m), int(d))
+
+
+def format_deadline(choice: str, deadline: date | None, raw_display: str | None = None):
+    """
+    Преобразует внутренние значения дедлайна в:
+    - deadline_human: человекочитаемое значение ("Сегодня", "Через неделю", "Без дедлайна", "2025-11-13", ...)
+    - deadline_str: финальная строка для summary, вида "<human> (DD.MM.YYYY)" или "без дедлайна"
+    """
+    choice = (choice or "").lower()
+
+    deadline_human = DEADLINE_LABELS.get(choice)
+    if deadline_human is None:
+        if choice == "custom" and raw_display:
+            # Показываем ровно то, что ввёл пользователь
+            deadline_human = raw_display
+        elif deadline:
+            deadline_human = deadline.strftime("%d.%m.%Y")
+        else:
+            deadline_human = "без дедлайна"
+
+    if deadline:
+        date_str = deadline.strftime("%d.%m.%Y")
+        deadline_str = f"{deadline_human} ({date_str})"
+    else:
+        deadline_str = deadline_human or "без дедлайна"
+
+    return deadline_human, deadline_str
+
+
+# ---------------------------------------------------------------------------
+#  Построение интерактивных сообщений (attachments) для шагов мастера
+# ---------------------------------------------------------------------------
+
+def build_task_summary(task_title, project_title, board_title, assignee_name, deadline_str, task_url=None):
+    """
+    Строит единообразное summary задачи:
+    Задача "<title>" создана в проекте: <project>, доска: <board>,
+    ответственный: <assignee>, дедлайн: <deadline>.
+    При наличии добавляет ссылку.
+    """
+    summary = (
+        f'Задача "{task_title}" создана в проекте: {project_title}, '
+        f'доска: {board_title}, ответственный: {assignee_name}, '
+        f'дедлайн: {deadline_str}.'
+    )
+    if task_url:
+        summary += f"\nСсылка: {task_url}"
+    return summary
 
 
 def send_task_summary(channel_id, root_post_id, summary, *, to_channel=False, auto=False):
@@ -762,6 +1462,18 @@ def send_task_summary(channel_id, root_post_id, summary, *, to_channel=False, au
         )
 
 
+# URL, на который Mattermost присылает нажатия кнопок / выбор в select'ах
+MM_ACTIONS_URL = f"{BOT_PUBLIC_URL}/mattermost/actions"
+
+
+def action_integration(step, **context):
+    """Блок integration для кнопки/select'а: наш webhook + context с шагом мастера."""
+    return {
+        "url": MM_ACTIONS_URL,
+        "context": {"step": step, **context},
+    }
+
+
 def add_cancel_action(actions, task_title, root_post_id, user_id):
     """
     Добавляет красную кнопку "Отменить" в конец списка actions.
@@ -771,198 +1483,186 @@ def add_cancel_action(actions, task_title, root_post_id, user_id):
         "name": "Отменить",
         "type": "button",
         "style": "danger",
-        "integration": {
-            "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-            "context": {
-                "step": "CANCEL",
-                "task_title": task_title,
-                "root_post_id": root_post_id,
-                "user_id": user_id,
-            }
-        }
+        "integration": action_integration(
+            "CANCEL",
+            task_title=task_title,
+            root_post_id=root_post_id,
+            user_id=user_id,
+        )
     })
     return actions
 
 
-def build_project_select_for_task(task_title, projects, user_id, root_post_id):
+# Тексты шагов мастера: подтверждение сделанного выбора и вопрос следующего шага
+CONFIRM_TEMPLATES = {
+    "project": 'Проект для задачи "{title}": {value}',
+    "board": 'Доска для задачи "{title}": {value}',
+    "column": 'Колонка для задачи "{title}": {value}',
+    "assignee": 'Ответственный для задачи "{title}": {value}',
+    "deadline": 'Дедлайн для задачи "{title}": {value}.',
+}
+
+PROMPT_TEMPLATES = {
+    "project": 'Выберите проект для задачи "{title}"',
+    "board": 'Выберите доску для задачи "{title}"',
+    "column": 'Выберите колонку для задачи "{title}"',
+    "assignee": 'Кого назначить ответственным за задачу "{title}"?',
+    "deadline": 'Какую дату дедлайна поставить для задачи "{title}"?',
+}
+
+
+def confirm_message(kind, task_title, value):
+    """Подтверждение выбора на шаге kind, например 'Доска для задачи "X": Y'."""
+    return CONFIRM_TEMPLATES[kind].format(title=task_title, value=value)
+
+
+def prompt_message(kind, task_title):
+    """Вопрос шага kind мастера, например 'Выберите доску для задачи "X"'."""
+    return PROMPT_TEMPLATES[kind].format(title=task_title)
+
+
+def build_title_options(items):
     """
-    Выпадающий список проектов для создания задачи.
+    Один проход по объектам YouGile с полями id / title (без id — пропускаются).
+    Возвращает (опции select'а, словарь id -> title для состояния мастера).
     """
     options = []
-    for p in projects:
-        pid = p.get("id")
-        title = p.get("title", "Без имени")
-        if not pid:
+    titles = {}
+    for item in items:
+        item_id = item.get("id")
+        if not item_id:
             continue
-        options.append({
-            "text": title,
-            "value": pid
-        })
+        title = item.get("title", "Без имени")
+        titles[item_id] = title
+        options.append({"text": title, "value": item_id})
+    return options, titles
+
 
+def wrap_select(label, select_action, task_title, root_post_id, user_id):
+    """Оборачивает select шага мастера в attachment с кнопкой "Отменить"."""
+    return [{
+        "text": label,
+        "actions": add_cancel_action([select_action], task_title, root_post_id, user_id)
+    }]
+
+
+def build_project_select_for_task(task_title, options, user_id, root_post_id):
+    """
+    Выпадающий список проектов для создания задачи.
+    """
     select_action = {
         "id": "projectSelect",
         "name": "Выберите проект",
         "type": "select",
         "options": options,
-        "integration": {
-            "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-            "context": {
-                "step": "CHOOSE_PROJECT",
-                "task_title": task_title,
-                "root_post_id": root_post_id,
-                "user_id": user_id,
-            }
-        }
+        "integration": action_integration(
+            "CHOOSE_PROJECT",
+            task_title=task_title,
+            root_post_id=root_post_id,
+            user_id=user_id,
+        )
     }
-
-    return [{
-        "text": "Проект:",
-        "actions": add_cancel_action([select_action], task_title, root_post_id, user_id)
-    }]
+    return wrap_select("Проект:", select_action, task_title, root_post_id, user_id)
 
 
-def build_board_select_for_task(task_title, project_id, boards, user_id, root_post_id):
+def build_board_select_for_task(task_title, project_id, options, user_id, root_post_id):
     """
     Выпадающий список досок для выбранного проекта.
     """
-    options = []
-    for b in boards:
-        bid = b.get("id")
-        title = b.get("title", "Без имени")
-        if not bid:
-            continue
-        options.append({
-            "text": title,
-            "value": bid
-        })
-
     select_action = {
         "id": "boardSelect",
         "name": "Выберите доску",
         "type": "select",
         "options": options,
-        "integration": {
-            "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-            "context": {
-                "step": "CHOOSE_BOARD",
-                "task_title": task_title,
-                "project_id": project_id,
-                "root_post_id": root_post_id,
-                "user_id": user_id,
-            }
-        }
+        "integration": action_integration(
+            "CHOOSE_BOARD",
+            task_title=task_title,
+            project_id=project_id,
+            root_post_id=root_post_id,
+            user_id=user_id,
+        )
     }
-
-    return [{
-        "text": "Доска:",
-        "actions": add_cancel_action([select_action], task_title, root_post_id, user_id)
-    }]
+    return wrap_select("Доска:", select_action, task_title, root_post_id, user_id)
 
 
-def build_column_select_for_task(task_title, project_id, board_id, columns, user_id, root_post_id):
+def build_column_select_for_task(task_title, project_id, board_id, options, user_id, root_post_id):
     """
     Выпадающий список колонок для выбранной доски.
     """
-    options = []
-    for c in columns:
-        cid = c.get("id")
-        title = c.get("title", "Без имени")
-        if not cid:
-            continue
-        options.append({
-            "text": title,
-            "value": cid
-        })
-
     select_action = {
         "id": "columnSelect",
         "name": "Выберите колонку",
         "type": "select",
         "options": options,
-        "integration": {
-            "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-            "context": {
-                "step": "CHOOSE_COLUMN",
-                "task_title": task_title,
-                "project_id": project_id,
-                "board_id": board_id,
-                "root_post_id": root_post_id,
-                "user_id": user_id,
-            }
-        }
+        "integration": action_integration(
+            "CHOOSE_COLUMN",
+            task_title=task_title,
+            project_id=project_id,
+            board_id=board_id,
+            root_post_id=root_post_id,
+            user_id=user_id,
+        )
     }
-
-    return [{
-        "text": "Колонка:",
-        "actions": add_cancel_action([select_action], task_title, root_post_id, user_id)
-    }]
+    return wrap_select("Колонка:", select_action, task_title, root_post_id, user_id)
 
 
 def build_assignee_select(task_title, project_id, board_id, column_id, users, user_id, root_post_id):
     """Селект выбора исполнителя + кнопка отмены."""
-    options = []
-    for u in users:
-        full_name = u.get("realName", "") or u.get("email", "Без имени")
-        options.append({
-            "text": full_name,
-            "value": u["id"]
-        })
+    options = [
+        {"text": u.get("realName", "") or u.get("email", "Без имени"), "value": uid}
+        for u in users
+        if (uid := u.get("id"))
+    ]
 
     base_action = {
         "id": "assigneeSelect",
         "name": "Выберите исполнителя",
         "type": "select",
         "options": options,
-        "integration": {
-            "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-            "context": {
-                "step": "CHOOSE_ASSIGNEE",
-                "task_title": task_title,
-                "project_id": project_id,
-                "board_id": board_id,
-                "column_id": column_id,
-                "root_post_id": root_post_id,
-                "user_id": user_id,
-            }
-        }
+        "integration": action_integration(
+            "CHOOSE_ASSIGNEE",
+            task_title=task_title,
+            project_id=project_id,
+            board_id=board_id,
+            column_id=column_id,
+            root_post_id=root_post_id,
+            user_id=user_id,
+        )
     }
+    return wrap_select("Исполнитель:", base_action, task_title, root_post_id, user_id)
 
-    return [{
-        "text": "Исполнитель:",
-        "actions": add_cancel_action([base_action], task_title, root_post_id, user_id)
-    }]
+
+# Кнопки дедлайна: (id, подпись, deadline_choice) — собираются один раз при импорте
+DEADLINE_BUTTONS = (
+    ("dlNone", "Без дедлайна", "none"),
+    ("dlToday", "Сегодня", "today"),
+    ("dlTomorrow", "Завтра", "tomorrow"),
+    ("dlDayAfter", "Послезавтра", "day_after_tomorrow"),
+    ("dlWeek", "Через неделю", "week"),
+    ("dlMonth", "Через месяц", "month"),
+    ("dlCustom", "Другая дата", "custom"),
+)
 
 
 def build_deadline_buttons(task_title, meta, user_id, root_post_id):
     """Кнопки выбора дедлайна."""
 
-    def act(id_, name, key):
-        ctx = {
-            "step": "CHOOSE_DEADLINE",
-            "task_title": task_title,
-            "root_post_id": root_post_id,
-            "user_id": user_id,
-            "deadline_choice": key,
-        }
-        ctx.update(meta)
-        return {
+    # общая часть context для всех кнопок — собираем один раз
+    base_ctx = {
+        "task_title": task_title,
+        "root_post_id": root_post_id,
+        "user_id": user_id,
+        **meta,
+    }
+
+    actions = [
+        {
             "id": id_,
             "name": name,
             "type": "button",
-            "integration": {
-                "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-                "context": ctx
-            }
+            "integration": action_integration("CHOOSE_DEADLINE", deadline_choice=key, **base_ctx)
         }
-
-    actions = [
-        act("dlNone", "Без дедлайна", "none"),
-        act("dlToday", "Сегодня", "today"),
-        act("dlTomorrow", "Завтра", "tomorrow"),
-        act("dlDayAfter", "Послезавтра", "day_after_tomorrow"),
-        act("dlWeek", "Через неделю", "week"),
-        act("dlMonth", "Через месяц", "month"),
-        act("dlCustom", "Другая дата", "custom"),
+        for id_, name, key in DEADLINE_BUTTONS
     ]
 
     add_cancel_action(actions, task_title, root_post_id, user_id)
@@ -981,16 +1681,13 @@ def build_finish_buttons(task_title, task_url, user_id, root_post_id, meta):
             "name": "Завершить",
             "type": "button",
             "style": "primary",
-            "integration": {
-                "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-                "context": {
-                    "step": "FINISH",
-                    "task_title": task_title,
-                    "root_post_id": root_post_id,
-                    "user_id": user_id,
-                    **meta
-                }
-            }
+            "integration": action_integration(
+                "FINISH",
+                task_title=task_title,
+                root_post_id=root_post_id,
+                user_id=user_id,
+                **meta,
+            )
         }
     ]
     return [{
@@ -1002,6 +1699,20 @@ def build_finish_buttons(task_title, task_url, user_id, root_post_id, meta):
     }]
 
 
+# Кнопки главного меню (без integration) и шаги, которые они запускают.
+# Собираются один раз при импорте; на каждый вызов добавляется только context.
+MAIN_MENU_ACTIONS = (
+    ({"id": "menuCreateTask", "name": "Создать задачу", "type": "button", "style": "primary"},
+     "MENU_CREATE_TASK"),
+    ({"id": "menuShowShortcuts", "name": "Показать быстрые команды", "type": "button"},
+     "MENU_SHOW_SHORTCUTS"),
+    ({"id": "menuChangeDefaultProject", "name": "Сменить проект по умолчанию", "type": "button"},
+     "MENU_CHANGE_DEFAULT_PROJECT"),
+    ({"id": "menuCancel", "name": "Завершить диалог", "type": "button", "style": "danger"},
+     "MENU_CANCEL"),
+)
+
+
 def build_main_menu_attachments(user_id, root_post_id):
     """
     Главное меню бота:
@@ -1011,60 +1722,8 @@ def build_main_menu_attachments(user_id, root_post_id):
     - Завершить диалог
     """
     actions = [
-        {
-            "id": "menuCreateTask",
-            "name": "Создать задачу",
-            "type": "button",
-            "style": "primary",
-            "integration": {
-                "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-                "context": {
-                    "step": "MENU_CREATE_TASK",
-                    "user_id": user_id,
-                    "root_post_id": root_post_id,
-                }
-            }
-        },
-        {
-            "id": "menuShowShortcuts",
-            "name": "Показать быстрые команды",
-            "type": "button",
-            "integration": {
-                "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-                "context": {
-                    "step": "MENU_SHOW_SHORTCUTS",
-                    "user_id": user_id,
-                    "root_post_id": root_post_id,
-                }
-            }
-        },
-        {
-            "id": "menuChangeDefaultProject",
-            "name": "Сменить проект по умолчанию",
-            "type": "button",
-            "integration": {
-                "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-                "context": {
-                    "step": "MENU_CHANGE_DEFAULT_PROJECT",
-                    "user_id": user_id,
-                    "root_post_id": root_post_id,
-                }
-            }
-        },
-        {
-            "id": "menuCancel",
-            "name": "Завершить диалог",
-            "type": "button",
-            "style": "danger",
-            "integration": {
-                "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-                "context": {
-                    "step": "MENU_CANCEL",
-                    "user_id": user_id,
-                    "root_post_id": root_post_id,
-                }
-            }
-        },
+        {**action, "integration": action_integration(step, user_id=user_id, root_post_id=root_post_id)}
+        for action, step in MAIN_MENU_ACTIONS
     ]
 
     return [{
@@ -1079,6 +1738,10 @@ def build_main_menu_attachments(user_id, root_post_id):
 
 app = Flask(__name__)
 
+# Фоновые обработчики интерактивных действий (см. mm_actions)
+ACTION_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="action")
+ACTION_DISPATCHER = OrderedDispatcher(ACTION_POOL)
+
 
 @app.route("/healthz", methods=["GET"])
 def healthz():
@@ -1089,14 +1752,15 @@ def healthz():
 @app.route("/mattermost/actions", methods=["POST"])
 def mm_actions():
     """
-    Обработчик интерактивных действий Mattermost:
-    - главное меню бота,
-    - выбор / сброс проекта по умолчанию,
-    - выбор проекта / доски / колонки / исполнителя / дедлайна,
-    - отмена мастера,
-    - ручное завершение диалога после создания задачи.
+    Webhook интерактивных действий Mattermost.
+    Проверяет payload, ставит действие в очередь ACTION_DISPATCHER и сразу отвечает 200,
+    не дожидаясь запросов к Loop / YouGile. Действия одного диалога выполняются по порядку.
     """
-    data = request.get_json(force=True, silent=True) or {}
+    # тело разбираем сами через json_loads (orjson), минуя стандартный JSON-провайдер Flask
+    try:
+        data = json_loads(request.get_data(cache=False) or b"{}") or {}
+    except ValueError:
+        data = {}
     context = data.get("context", {}) or {}
     step = context.get("step")
 
@@ -1107,623 +1771,697 @@ def mm_actions():
     # если root_post_id не передан в контексте, берём сам post_id
     root_post_id = context.get("root_post_id") or data.get("root_id") or post_id
 
-    if not (step and user_id and root_post_id and post_id and channel_id):
+    # неизвестные шаги отсекаем сразу, не занимая очередь диалога
+    if not (step in STEP_HANDLERS and user_id and root_post_id and post_id and channel_id):
         return "", 200
 
+    ACTION_DISPATCHER.submit(
+        (user_id, root_post_id),
+        handle_action,
+        data, context, step, user_id, post_id, channel_id, root_post_id,
+    )
+    return "", 200
+
+
+def report_yougile_unavailable(user_id, channel_id, root_post_id):
+    """YouGile недоступен: сообщаем об этом в тред и сбрасываем диалог, чтобы он не завис."""
+    clear_state(user_id, root_post_id)
+    try:
+        mm_post(channel_id, YG_UNAVAILABLE_MESSAGE, root_id=root_post_id)
+    except Exception:
+        logger.exception("Error reporting YouGile outage")
+
+
+@dataclass(slots=True)
+class ActionContext:
+    """Всё, что нужно обработчику шага: payload действия, контекст кнопки и состояние диалога."""
+    data: dict
+    context: dict
+    step: str
+    user_id: str
+    post_id: str
+    channel_id: str
+    root_post_id: str
+    state: dict
+    task_title: str
+
+    def pick(self, key):
+        """
+        Значение из context нажатой кнопки (select'ы мастера кладут туда project_id /
+        board_id / column_id), а для старых диалогов без него — из состояния.
+        """
+        return self.context.get(key) or self.state.get(key)
+
+
+def handle_action(data, context, step, user_id, post_id, channel_id, root_post_id):
+    """
+    Обработчик интерактивных действий Mattermost (выполняется в фоне).
+    Находит обработчик шага в STEP_HANDLERS и вызывает его с ActionContext.
+    """
+    handler = STEP_HANDLERS.get(step)
+    if handler is None:
+        return
+
     state = get_state(user_id, root_post_id) or {}
-    task_title = context.get("task_title") or state.get("task_title", "Без названия")
+    ctx = ActionContext(
+        data=data,
+        context=context,
+        step=step,
+        user_id=user_id,
+        post_id=post_id,
+        channel_id=channel_id,
+        root_post_id=root_post_id,
+        state=state,
+        task_title=context.get("task_title") or state.get("task_title", "Без названия"),
+    )
 
     try:
-        # ---------- ГЛАВНОЕ МЕНЮ ----------
-        if step == "MENU_CREATE_TASK":
-            # Начинаем диалог: ждём название задачи
-            set_state(user_id, root_post_id, {
-                "step": "ASK_TASK_TITLE",
-                "channel_id": channel_id,
-                "task_title": None,
-                # запоминаем сообщение, где просили ввести название
-                "ask_title_post_id": post_id,
-                # и сразу считаем его служебным, чтобы CANCEL мог удалить
-                "post_ids": [post_id],
-            })
+        handler(ctx)
+    except CircuitOpenError:
+        report_yougile_unavailable(user_id, channel_id, root_post_id)
+    except Exception as e:
+        logger.exception("Error in handle_action")
+        try:
+            mm_post(channel_id, f"💥 Ошибка обработки действия бота: {e}", root_id=root_post_id)
+        except Exception:
+            pass
 
-            # Кнопка "Отменить" для этого шага
-            attachments = [{
-                "text": "Назовите задачу:",
-                "actions": add_cancel_action([], "Без названия", root_post_id, user_id)
-            }]
 
-            mm_patch_post(
-                post_id,
-                message='Пожалуйста, введите название задачи в этом треде.',
-                attachments=attachments
-            )
+# ---------------------------------------------------------------------------
+#  Обработчики шагов интерактивных действий
+#  (главное меню, проект по умолчанию, шаги мастера, отмена, завершение)
+# ---------------------------------------------------------------------------
 
-            return "", 200
+# ---------- ГЛАВНОЕ МЕНЮ ----------
+
+def action_menu_create_task(ctx):
+    # Начинаем диалог: ждём название задачи
+    set_state(ctx.user_id, ctx.root_post_id, {
+        "step": "ASK_TASK_TITLE",
+        "channel_id": ctx.channel_id,
+        "task_title": None,
+        # запоминаем сообщение, где просили ввести название
+        "ask_title_post_id": ctx.post_id,
+        # и сразу считаем его служебным, чтобы CANCEL мог удалить
+        "post_ids": [ctx.post_id],
+    })
 
-        elif step == "MENU_SHOW_SHORTCUTS":
-            shortcuts_text = (
-                "Быстрые команды:\n"
-                "- `создай задачу <название задачи>` — сразу запустить мастер создания задачи.\n\n"
-                "Можно также воспользоваться главным меню, упомянув бота."
-            )
-            mm_post(
-                channel_id,
-                message=shortcuts_text,
-                root_id=root_post_id
-            )
-            return "", 200
+    # Кнопка "Отменить" для этого шага
+    attachments = [{
+        "text": "Назовите задачу:",
+        "actions": add_cancel_action([], "Без названия", ctx.root_post_id, ctx.user_id)
+    }]
 
-        elif step == "MENU_CHANGE_DEFAULT_PROJECT":
-            # Показываем текущий проект по умолчанию и даём выбрать новый
-            allowed_projects = get_allowed_projects_for_mm_user(user_id)
-            if not allowed_projects:
-                mm_post(
-                    channel_id,
-                    message="Не нашёл для вас доступных проектов в YouGile. Обратитесь к администратору.",
-                    root_id=root_post_id
-                )
-                return "", 200
+    mm_patch_post(
+        ctx.post_id,
+        message='Пожалуйста, введите название задачи в этом треде.',
+        attachments=attachments
+    )
 
-            project_options = {
-                p["id"]: p.get("title", "Без имени")
-                for p in allowed_projects
-                if p.get("id")
-            }
 
-            channel = mm_get_channel(channel_id)
-            channel_name = channel.get("display_name") or channel.get("name") or channel_id
+def action_menu_show_shortcuts(ctx):
+    shortcuts_text = (
+        "Быстрые команды:\n"
+        "- `создай задачу <название задачи>` — сразу запустить мастер создания задачи.\n\n"
+        "Можно также воспользоваться главным меню, упомянув бота."
+    )
+    mm_post(
+        ctx.channel_id,
+        message=shortcuts_text,
+        root_id=ctx.root_post_id
+    )
 
-            current = get_default_project_for_channel(channel_id)
-            if current:
-                current_title = current.get("project_title", "не установлен")
-            else:
-                current_title = "не установлен"
 
-            set_state(user_id, root_post_id, {
-                "step": "MENU_CHANGE_DEFAULT_PROJECT",
-                "channel_id": channel_id,
-                "project_options": project_options,
-            })
+def action_menu_change_default_project(ctx):
+    # Показываем текущий проект по умолчанию и даём выбрать новый
+    allowed_projects = get_allowed_projects_for_mm_user(ctx.user_id)
+    if not allowed_projects:
+        mm_post(
+            ctx.channel_id,
+            message="Не нашёл для вас доступных проектов в YouGile. Обратитесь к администратору.",
+            root_id=ctx.root_post_id
+        )
+        return
 
-            # "Не выбирать проект автоматически" — последним пунктом в списке
-            options = [
-                {"text": title, "value": pid}
-                for pid, title in project_options.items()
-            ] + [
-                {"text": "Не выбирать проект автоматически", "value": "__none__"},
-            ]
-
-            select_action = {
-                "id": "defaultProjectSelectChange",
-                "name": "Выберите новый проект",
-                "type": "select",
-                "options": options,
-                "integration": {
-                    "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-                    "context": {
-                        "step": "MENU_DEFAULT_PROJECT_SET",
-                        "root_post_id": root_post_id,
-                    }
-                }
-            }
+    options, project_options = build_title_options(allowed_projects)
 
-            cancel_action = {
-                "id": "cancelDefaultProjectChange",
-                "name": "Не менять",
-                "type": "button",
-                "integration": {
-                    "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-                    "context": {
-                        "step": "MENU_DEFAULT_PROJECT_CANCEL",
-                        "root_post_id": root_post_id,
-                    }
-                }
-            }
+    channel = mm_get_channel(ctx.channel_id)
+    channel_name = channel.get("display_name") or channel.get("name") or ctx.channel_id
 
-            text = (
-                f'Сейчас проект по умолчанию для чата "{channel_name}": {current_title}\n'
-                f"Выберите новый проект:"
-            )
+    current = get_default_project_for_channel(ctx.channel_id)
+    if current:
+        current_title = current.get("project_title", "не установлен")
+    else:
+        current_title = "не установлен"
 
-            attachments = [{
-                "text": text,
-                "actions": [select_action, cancel_action]
-            }]
+    set_state(ctx.user_id, ctx.root_post_id, {
+        "step": "MENU_CHANGE_DEFAULT_PROJECT",
+        "channel_id": ctx.channel_id,
+        "project_options": project_options,
+    })
 
-            mm_patch_post(
-                post_id,
-                message=text,
-                attachments=attachments
-            )
+    # "Не выбирать проект автоматически" — последним пунктом в списке
+    options.append({"text": "Не выбирать проект автоматически", "value": "__none__"})
 
-            return "", 200
+    select_action = {
+        "id": "defaultProjectSelectChange",
+        "name": "Выберите новый проект",
+        "type": "select",
+        "options": options,
+        "integration": action_integration(
+            "MENU_DEFAULT_PROJECT_SET",
+            root_post_id=ctx.root_post_id,
+        )
+    }
 
-        elif step == "MENU_DEFAULT_PROJECT_CANCEL":
-            mm_patch_post(
-                post_id,
-                message="Смена проекта по умолчанию отменена. Старое значение сохранено.",
-                attachments=[]
-            )
-            clear_state(user_id, root_post_id)
-            return "", 200
-
-        elif step == "MENU_DEFAULT_PROJECT_SET":
-            project_id = extract_selected_value(data)
-            if not project_id:
-                return "", 200
-
-            if project_id == "__none__":
-                # очищаем маппинг
-                delete_default_project_for_channel(channel_id)
-                mm_patch_post(
-                    post_id,
-                    message="Проект по умолчанию для этого чата отключён. Буду спрашивать проект при создании задач.",
-                    attachments=[]
-                )
-                clear_state(user_id, root_post_id)
-                return "", 200
+    cancel_action = {
+        "id": "cancelDefaultProjectChange",
+        "name": "Не менять",
+        "type": "button",
+        "integration": action_integration(
+            "MENU_DEFAULT_PROJECT_CANCEL",
+            root_post_id=ctx.root_post_id,
+        )
+    }
 
-            st = get_state(user_id, root_post_id) or {}
-            project_options = st.get("project_options", {})
-            project_title = project_options.get(project_id, "без названия")
+    text = (
+        f'Сейчас проект по умолчанию для чата "{channel_name}": {current_title}\n'
+        f"Выберите новый проект:"
+    )
 
-            set_default_project_for_channel(channel_id, project_id, project_title)
+    attachments = [{
+        "text": text,
+        "actions": [select_action, cancel_action]
+    }]
 
-            mm_patch_post(
-                post_id,
-                message=f'Проект по умолчанию для этого чата изменён на: {project_title}',
-                attachments=[]
-            )
+    mm_patch_post(
+        ctx.post_id,
+        message=text,
+        attachments=attachments
+    )
 
-            clear_state(user_id, root_post_id)
-            return "", 200
 
-        elif step == "MENU_CANCEL":
-            mm_patch_post(
-                post_id,
-                message="Диалог с ботом завершён. Если что — зовите ещё! :wink:",
-                attachments=[]
-            )
-            clear_state(user_id, root_post_id)
-            return "", 200
+def action_menu_default_project_cancel(ctx):
+    mm_patch_post(
+        ctx.post_id,
+        message="Смена проекта по умолчанию отменена. Старое значение сохранено.",
+        attachments=[]
+    )
+    clear_state(ctx.user_id, ctx.root_post_id)
 
-        # ---------- ВОПРОС ПРО ПРОЕКТ ПО УМОЛЧАНИЮ (ПРИ ДОБАВЛЕНИИ БОТА В КАНАЛ) ----------
-        elif step == "DEFAULT_PROJECT_PROMPT_NO":
-            # Пользователь явно отказался от проекта по умолчанию → чистим мэппинг
-            delete_default_project_for_channel(channel_id)
 
-            # Обновляем текущее сообщение (где были кнопки) и выключаем их
-            mm_patch_post(
-                post_id,
-                message="Ок, проект по умолчанию для этого чата не установлен. Буду спрашивать проект при создании задач.",
-                attachments=[]
-            )
+def action_menu_default_project_set(ctx):
+    project_id = extract_selected_value(ctx.data)
+    if not project_id:
+        return
 
-            clear_state(user_id, root_post_id)
-            return "", 200
+    if project_id == "__none__":
+        # очищаем маппинг
+        delete_default_project_for_channel(ctx.channel_id)
+        mm_patch_post(
+            ctx.post_id,
+            message="Проект по умолчанию для этого чата отключён. Буду спрашивать проект при создании задач.",
+            attachments=[]
+        )
+        clear_state(ctx.user_id, ctx.root_post_id)
+        return
 
-        elif step == "DEFAULT_PROJECT_PROMPT_YES":
-            # user_id здесь — тот, кто нажал кнопку
-            allowed_projects = get_allowed_projects_for_mm_user(user_id)
-            if not allowed_projects:
-                mm_post(
-                    channel_id,
-                    message="Не нашёл для вас доступных проектов в YouGile. Обратитесь к администратору.",
-                    root_id=root_post_id
-                )
-                return "", 200
+    st = ctx.state
+    project_options = st.get("project_options", {})
+    project_title = project_options.get(project_id, "без названия")
 
-            project_options = {
-                p["id"]: p.get("title", "Без имени")
-                for p in allowed_projects
-                if p.get("id")
-            }
+    set_default_project_for_channel(ctx.channel_id, project_id, project_title)
 
-            set_state(user_id, root_post_id, {
-                "step": "DEFAULT_PROJECT_SELECT",
-                "channel_id": channel_id,
-                "project_options": project_options,
-            })
+    mm_patch_post(
+        ctx.post_id,
+        message=f'Проект по умолчанию для этого чата изменён на: {project_title}',
+        attachments=[]
+    )
 
-            # "Не выбирать проект автоматически" ПЕРВОЙ
-            options = [
-                {"text": "Не выбирать проект автоматически", "value": "__none__"},
-            ] + [
-                {"text": title, "value": pid}
-                for pid, title in project_options.items()
-            ]
-
-            select_action = {
-                "id": "defaultProjectSelect",
-                "name": "Выберите проект",
-                "type": "select",
-                "options": options,
-                "integration": {
-                    "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-                    "context": {
-                        "step": "DEFAULT_PROJECT_SET",
-                        "root_post_id": root_post_id,
-                    }
-                }
-            }
+    clear_state(ctx.user_id, ctx.root_post_id)
 
-            attachments = [{
-                "text": "Выберите проект по умолчанию для этого чата:",
-                "actions": [select_action]
-            }]
 
-            # Обновляем исходный пост с кнопками "Да/Нет"
-            mm_patch_post(
-                post_id,
-                message="Проект по умолчанию:",
-                attachments=attachments
-            )
+def action_menu_cancel(ctx):
+    mm_patch_post(
+        ctx.post_id,
+        message="Диалог с ботом завершён. Если что — зовите ещё! :wink:",
+        attachments=[]
+    )
+    clear_state(ctx.user_id, ctx.root_post_id)
 
-            return "", 200
 
-        elif step == "DEFAULT_PROJECT_SET":
-            project_id = extract_selected_value(data)
-            if not project_id:
-                return "", 200
+# ---------- ВОПРОС ПРО ПРОЕКТ ПО УМОЛЧАНИЮ (ПРИ ДОБАВЛЕНИИ БОТА В КАНАЛ) ----------
 
-            if project_id == "__none__":
-                delete_default_project_for_channel(channel_id)
-                mm_patch_post(
-                    post_id,
-                    message="Проект по умолчанию для этого чата не будет выбран автоматически. Буду спрашивать проект при создании задач.",
-                    attachments=[]
-                )
-                clear_state(user_id, root_post_id)
-                return "", 200
+def action_default_project_prompt_no(ctx):
+    # Пользователь явно отказался от проекта по умолчанию → чистим мэппинг
+    delete_default_project_for_channel(ctx.channel_id)
 
-            st = get_state(user_id, root_post_id) or {}
-            project_options = st.get("project_options", {})
-            project_title = project_options.get(project_id, "без названия")
+    # Обновляем текущее сообщение (где были кнопки) и выключаем их
+    mm_patch_post(
+        ctx.post_id,
+        message="Ок, проект по умолчанию для этого чата не установлен. Буду спрашивать проект при создании задач.",
+        attachments=[]
+    )
 
-            set_default_project_for_channel(channel_id, project_id, project_title)
+    clear_state(ctx.user_id, ctx.root_post_id)
 
-            mm_patch_post(
-                post_id,
-                message=f'Проект по умолчанию для этого чата установлен: {project_title}',
-                attachments=[]
-            )
 
-            clear_state(user_id, root_post_id)
-            return "", 200
-
-        # ---------- ВЫБОР ПРОЕКТА (через select мастера) ----------
-        elif step == "CHOOSE_PROJECT":
-            project_id = extract_selected_value(data)
-            if not project_id:
-                return "", 200
-
-            state = get_state(user_id, root_post_id) or {}
-            project_options = state.get("project_options", {})
-            project_title = project_options.get(project_id, "без названия")
-
-            state = set_state(user_id, root_post_id, {
-                "step": "CHOOSE_PROJECT",
-                "task_title": task_title,
-                "project_id": project_id,
-                "project_title": project_title,
-                "channel_id": channel_id,
-            })
+def action_default_project_prompt_yes(ctx):
+    # user_id здесь — тот, кто нажал кнопку
+    allowed_projects = get_allowed_projects_for_mm_user(ctx.user_id)
+    if not allowed_projects:
+        mm_post(
+            ctx.channel_id,
+            message="Не нашёл для вас доступных проектов в YouGile. Обратитесь к администратору.",
+            root_id=ctx.root_post_id
+        )
+        return
 
-            boards = yg_get_boards(project_id)
+    options, project_options = build_title_options(allowed_projects)
 
-            mm_patch_post(
-                post_id,
-                message=f'Проект для задачи "{task_title}": {project_title}',
-                attachments=[]
-            )
+    set_state(ctx.user_id, ctx.root_post_id, {
+        "step": "DEFAULT_PROJECT_SELECT",
+        "channel_id": ctx.channel_id,
+        "project_options": project_options,
+    })
 
-            if not boards:
-                mm_post(
-                    channel_id,
-                    message=f'В проекте "{project_title}" нет досок, задачу создать нельзя.',
-                    root_id=root_post_id
-                )
-                return "", 200
-
-            if len(boards) == 1:
-                board = boards[0]
-                board_id = board["id"]
-                board_title = board.get("title", "без названия")
-
-                state = set_state(user_id, root_post_id, {
-                    "step": "CHOOSE_BOARD",
-                    "board_id": board_id,
-                    "board_title": board_title,
-                })
-
-                columns = yg_get_columns(board_id)
-                if not columns:
-                    mm_post(
-                        channel_id,
-                        message=f'На доске "{board_title}" нет колонок, задачу создать нельзя.',
-                        root_id=root_post_id
-                    )
-                    return "", 200
-
-                column_options = {c["id"]: c.get("title", "Без имени") for c in columns if c.get("id")}
-                set_state(user_id, root_post_id, {"column_options": column_options})
-
-                attachments = build_column_select_for_task(task_title, project_id, board_id, columns, user_id, root_post_id)
-                resp = mm_post(
-                    channel_id,
-                    message=f'Выберите колонку для задачи "{task_title}"',
-                    attachments=attachments,
-                    root_id=root_post_id
-                )
-                set_state(user_id, root_post_id, {
-                    "post_ids": state.get("post_ids", []) + [resp["id"]]
-                })
-            else:
-                board_options = {b["id"]: b.get("title", "Без имени") for b in boards if b.get("id")}
-                set_state(user_id, root_post_id, {"board_options": board_options})
-
-                attachments = build_board_select_for_task(task_title, project_id, boards, user_id, root_post_id)
-                resp = mm_post(
-                    channel_id,
-                    message=f'Выберите доску для задачи "{task_title}"',
-                    attachments=attachments,
-                    root_id=root_post_id
-                )
-                set_state(user_id, root_post_id, {
-                    "post_ids": state.get("post_ids", []) + [resp["id"]]
-                })
-
-        # ---------- ВЫБОР ДОСКИ ----------
-        elif step == "CHOOSE_BOARD":
-            board_id = extract_selected_value(data)
-            if not board_id:
-                return "", 200
-
-            state = get_state(user_id, root_post_id) or {}
-            project_id = state.get("project_id") or context.get("project_id")
-            board_options = state.get("board_options", {})
-            board_title = board_options.get(board_id, "без названия")
-
-            state = set_state(user_id, root_post_id, {
-                "step": "CHOOSE_BOARD",
-                "project_id": project_id,
-                "board_id": board_id,
-                "board_title": board_title,
-            })
+    # "Не выбирать проект автоматически" ПЕРВОЙ
+    options.insert(0, {"text": "Не выбирать проект автоматически", "value": "__none__"})
 
-            columns = yg_get_columns(board_id)
-            if not columns:
-                mm_patch_post(
-                    post_id,
-                    message=f'На доске "{board_title}" нет колонок, задачу создать нельзя.',
-                    attachments=[]
-                )
-                return "", 200
+    select_action = {
+        "id": "defaultProjectSelect",
+        "name": "Выберите проект",
+        "type": "select",
+        "options": options,
+        "integration": action_integration(
+            "DEFAULT_PROJECT_SET",
+            root_post_id=ctx.root_post_id,
+        )
+    }
+
+    attachments = [{
+        "text": "Выберите проект по умолчанию для этого чата:",
+        "actions": [select_action]
+    }]
 
-            column_options = {c["id"]: c.get("title", "Без имени") for c in columns if c.get("id")}
-            set_state(user_id, root_post_id, {"column_options": column_options})
+    # Обновляем исходный пост с кнопками "Да/Нет"
+    mm_patch_post(
+        ctx.post_id,
+        message="Проект по умолчанию:",
+        attachments=attachments
+    )
 
-            attachments = build_column_select_for_task(task_title, project_id, board_id, columns, user_id, root_post_id)
 
-            mm_patch_post(
-                post_id,
-                message=f'Доска для задачи "{task_title}": {board_title}',
-                attachments=[]
-            )
+def action_default_project_set(ctx):
+    project_id = extract_selected_value(ctx.data)
+    if not project_id:
+        return
 
-            resp = mm_post(
-                channel_id,
-                message=f'Выберите колонку для задачи "{task_title}"',
-                attachments=attachments,
-                root_id=root_post_id
-            )
-            set_state(user_id, root_post_id, {
-                "post_ids": state.get("post_ids", []) + [resp["id"]]
-            })
+    if project_id == "__none__":
+        delete_default_project_for_channel(ctx.channel_id)
+        mm_patch_post(
+            ctx.post_id,
+            message="Проект по умолчанию для этого чата не будет выбран автоматически. Буду спрашивать проект при создании задач.",
+            attachments=[]
+        )
+        clear_state(ctx.user_id, ctx.root_post_id)
+        return
 
-        # ---------- ВЫБОР КОЛОНКИ ----------
-        elif step == "CHOOSE_COLUMN":
-            column_id = extract_selected_value(data)
-            if not column_id:
-                return "", 200
-
-            state = get_state(user_id, root_post_id) or {}
-            project_id = state.get("project_id") or context.get("project_id")
-            board_id = state.get("board_id") or context.get("board_id")
-            column_options = state.get("column_options", {})
-            column_title = column_options.get(column_id, "без названия")
-
-            state = set_state(user_id, root_post_id, {
-                "step": "CHOOSE_COLUMN",
-                "project_id": project_id,
-                "board_id": board_id,
-                "column_id": column_id,
-            })
+    st = ctx.state
+    project_options = st.get("project_options", {})
+    project_title = project_options.get(project_id, "без названия")
 
-            users = yg_get_project_users(project_id)
-            attachments = build_assignee_select(
-                task_title, project_id, board_id, column_id, users, user_id, root_post_id
-            )
+    set_default_project_for_channel(ctx.channel_id, project_id, project_title)
 
-            mm_patch_post(
-                post_id,
-                message=f'Колонка для задачи "{task_title}": {column_title}',
-                attachments=[]
-            )
+    mm_patch_post(
+        ctx.post_id,
+        message=f'Проект по умолчанию для этого чата установлен: {project_title}',
+        attachments=[]
+    )
 
-            resp = mm_post(
-                channel_id,
-                message=f'Кого назначить ответственным за задачу "{task_title}"?',
-                attachments=attachments,
-                root_id=root_post_id
-            )
-            set_state(user_id, root_post_id, {
-                "post_ids": state.get("post_ids", []) + [resp["id"]]
-            })
+    clear_state(ctx.user_id, ctx.root_post_id)
 
-        # ---------- ВЫБОР ИСПОЛНИТЕЛЯ ----------
-        elif step == "CHOOSE_ASSIGNEE":
-            assignee_id = extract_selected_value(data)
-            if not assignee_id:
-                return "", 200
 
-            state = set_state(user_id, root_post_id, {
-                "step": "CHOOSE_ASSIGNEE",
-                "assignee_id": assignee_id,
-            })
+# ---------- ВЫБОР ПРОЕКТА (через select мастера) ----------
 
-            assignee_name = assignee_id
-            project_id = state.get("project_id") or context.get("project_id")
+def action_choose_project(ctx):
+    project_id = extract_selected_value(ctx.data)
+    if not project_id:
+        return
 
-            try:
-                users = yg_get_project_users(project_id)
-                for u in users:
-                    if u.get("id") == assignee_id:
-                        assignee_name = u.get("realName") or u.get("email") or assignee_id
-                        break
-            except Exception as e:
-                print("Error fetching project users:", e)
-
-            state = set_state(user_id, root_post_id, {
-                "assignee_name": assignee_name,
-            })
+    state = ctx.state
+    project_options = state.get("project_options", {})
+    project_title = project_options.get(project_id, "без названия")
+
+    # все изменения шага копим здесь и записываем в состояние одним set_state
+    updates = {
+        "step": "CHOOSE_PROJECT",
+        "task_title": ctx.task_title,
+        "project_id": project_id,
+        "project_title": project_title,
+        "channel_id": ctx.channel_id,
+    }
 
-            meta = {
-                "project_id": state.get("project_id"),
-                "board_id": state.get("board_id"),
-                "column_id": state.get("column_id"),
-                "assignee_id": assignee_id,
-            }
-            attachments = build_deadline_buttons(task_title, meta, user_id, root_post_id)
+    # подтверждение выбора не зависит ни от досок, ни от колонок, ни от следующего
+    # вопроса — дожидаемся его только перед выходом
+    patch_future = IO_POOL.submit(
+        mm_patch_post,
+        ctx.post_id,
+        message=confirm_message("project", ctx.task_title, project_title),
+        attachments=[]
+    )
+    # пользователи проекта понадобятся через шаг (выбор исполнителя) — прогреваем кеш заранее
+    IO_POOL.submit(yg_get_project_users, project_id)
+    boards = yg_get_boards(project_id)
+
+    if not boards:
+        patch_future.result()
+        set_state(ctx.user_id, ctx.root_post_id, updates)
+        # пустой список не держим в кеше: доски могут завести, пока пользователь ждёт
+        cache_invalidate("yg_get_boards", project_id)
+        mm_post(
+            ctx.channel_id,
+            message=f'В проекте "{project_title}" нет досок, задачу создать нельзя.',
+            root_id=ctx.root_post_id
+        )
+        return
 
-            mm_patch_post(
-                post_id,
-                message=f'Ответственный для задачи "{task_title}": {assignee_name}',
-                attachments=[]
-            )
+    if len(boards) == 1:
+        board = boards[0]
+        board_id = board["id"]
+        board_title = board.get("title", "без названия")
 
-            resp = mm_post(
-                channel_id,
-                message=f'Какую дату дедлайна поставить для задачи "{task_title}"?',
-                attachments=attachments,
-                root_id=root_post_id
+        updates.update({
+            "step": "CHOOSE_BOARD",
+            "board_id": board_id,
+            "board_title": board_title,
+        })
+
+        columns = yg_get_columns(board_id)
+        if not columns:
+            patch_future.result()
+            set_state(ctx.user_id, ctx.root_post_id, updates)
+            cache_invalidate("yg_get_columns", board_id)
+            mm_post(
+                ctx.channel_id,
+                message=f'На доске "{board_title}" нет колонок, задачу создать нельзя.',
+                root_id=ctx.root_post_id
             )
+            return
+
+        options, updates["column_options"] = build_title_options(columns)
+
+        attachments = build_column_select_for_task(ctx.task_title, project_id, board_id, options, ctx.user_id, ctx.root_post_id)
+        resp = mm_post(
+            ctx.channel_id,
+            message=prompt_message("column", ctx.task_title),
+            attachments=attachments,
+            root_id=ctx.root_post_id
+        )
+    else:
+        options, updates["board_options"] = build_title_options(boards)
+
+        attachments = build_board_select_for_task(ctx.task_title, project_id, options, ctx.user_id, ctx.root_post_id)
+        resp = mm_post(
+            ctx.channel_id,
+            message=prompt_message("board", ctx.task_title),
+            attachments=attachments,
+            root_id=ctx.root_post_id
+        )
+
+    patch_future.result()
+    updates["post_ids"] = state.get("post_ids", []) + [resp["id"]]
+    set_state(ctx.user_id, ctx.root_post_id, updates)
+
+
+# ---------- ВЫБОР ДОСКИ ----------
+
+def action_choose_board(ctx):
+    board_id = extract_selected_value(ctx.data)
+    if not board_id:
+        return
+
+    state = ctx.state
+    project_id = ctx.pick("project_id")
+    board_options = state.get("board_options", {})
+    board_title = board_options.get(board_id, "без названия")
+
+    updates = {
+        "step": "CHOOSE_BOARD",
+        "project_id": project_id,
+        "board_id": board_id,
+        "board_title": board_title,
+    }
+
+    columns = yg_get_columns(board_id)
+    if not columns:
+        set_state(ctx.user_id, ctx.root_post_id, updates)
+        cache_invalidate("yg_get_columns", board_id)
+        mm_patch_post(
+            ctx.post_id,
+            message=f'На доске "{board_title}" нет колонок, задачу создать нельзя.',
+            attachments=[]
+        )
+        return
+
+    options, updates["column_options"] = build_title_options(columns)
+
+    attachments = build_column_select_for_task(ctx.task_title, project_id, board_id, options, ctx.user_id, ctx.root_post_id)
+
+    # подтверждение выбора и следующий вопрос друг от друга не зависят — отправляем параллельно
+    patch_future = IO_POOL.submit(
+        mm_patch_post,
+        ctx.post_id,
+        message=confirm_message("board", ctx.task_title, board_title),
+        attachments=[]
+    )
+    resp = mm_post(
+        ctx.channel_id,
+        message=prompt_message("column", ctx.task_title),
+        attachments=attachments,
+        root_id=ctx.root_post_id
+    )
+    patch_future.result()
+    updates["post_ids"] = state.get("post_ids", []) + [resp["id"]]
+    set_state(ctx.user_id, ctx.root_post_id, updates)
+
+
+# ---------- ВЫБОР КОЛОНКИ ----------
+
+def action_choose_column(ctx):
+    column_id = extract_selected_value(ctx.data)
+    if not column_id:
+        return
+
+    state = ctx.state
+    project_id = ctx.pick("project_id")
+    board_id = ctx.pick("board_id")
+    column_options = state.get("column_options", {})
+    column_title = column_options.get(column_id, "без названия")
+
+    # подтверждение выбора не ждёт ни пользователей проекта, ни следующего вопроса
+    patch_future = IO_POOL.submit(
+        mm_patch_post,
+        ctx.post_id,
+        message=confirm_message("column", ctx.task_title, column_title),
+        attachments=[]
+    )
+    users = yg_get_project_users(project_id)
+    attachments = build_assignee_select(
+        ctx.task_title, project_id, board_id, column_id, users, ctx.user_id, ctx.root_post_id
+    )
+
+    resp = mm_post(
+        ctx.channel_id,
+        message=prompt_message("assignee", ctx.task_title),
+        attachments=attachments,
+        root_id=ctx.root_post_id
+    )
+    patch_future.result()
+    set_state(ctx.user_id, ctx.root_post_id, {
+        "step": "CHOOSE_COLUMN",
+        "project_id": project_id,
+        "board_id": board_id,
+        "column_id": column_id,
+        "post_ids": state.get("post_ids", []) + [resp["id"]],
+    })
+
+
+# ---------- ВЫБОР ИСПОЛНИТЕЛЯ ----------
+
+def action_choose_assignee(ctx):
+    assignee_id = extract_selected_value(ctx.data)
+    if not assignee_id:
+        return
+
+    state = ctx.state
+    assignee_name = assignee_id
+    project_id = ctx.pick("project_id")
+
+    try:
+        u = yg_get_project_users_by_id(project_id).get(assignee_id)
+        if u is None:
+            # Индекс мог устареть относительно показанного списка
+            cache_invalidate("yg_get_project_users", project_id)
+            cache_invalidate("yg_get_project_users_by_id", project_id)
+            u = yg_get_project_users_by_id(project_id).get(assignee_id)
+        if u:
+            assignee_name = u.get("realName") or u.get("email") or assignee_id
+    except Exception:
+        logger.exception("Error fetching project users")
+
+    meta = {
+        "project_id": project_id,
+        "project_title": ctx.pick("project_title"),  # для ссылки на задачу
+        "board_id": ctx.pick("board_id"),
+        "column_id": ctx.pick("column_id"),
+        "assignee_id": assignee_id,
+    }
+    attachments = build_deadline_buttons(ctx.task_title, meta, ctx.user_id, ctx.root_post_id)
+
+    patch_future = IO_POOL.submit(
+        mm_patch_post,
+        ctx.post_id,
+        message=confirm_message("assignee", ctx.task_title, assignee_name),
+        attachments=[]
+    )
+    resp = mm_post(
+        ctx.channel_id,
+        message=prompt_message("deadline", ctx.task_title),
+        attachments=attachments,
+        root_id=ctx.root_post_id
+    )
+    patch_future.result()
+
+    set_state(ctx.user_id, ctx.root_post_id, {
+        "step": "CHOOSE_ASSIGNEE",
+        "assignee_id": assignee_id,
+        "assignee_name": assignee_name,
+        "post_ids": state.get("post_ids", []) + [resp["id"]],
+    })
+
+
+# ---------- ВЫБОР ДЕДЛАЙНА ----------
+
+def action_choose_deadline(ctx):
+    deadline_choice = ctx.context.get("deadline_choice")
+    # Всё, что нужно для создания задачи, берём и из context кнопок: диалог, простоявший
+    # дольше STATE_TTL_SECONDS, уже убран из state, но задачу всё равно надо создать.
+    updates = {
+        "step": "CHOOSE_DEADLINE",
+        "deadline_choice": deadline_choice,
+        "task_title": ctx.task_title,
+        "root_post_id": ctx.root_post_id,
+        "channel_id": ctx.state.get("channel_id") or ctx.channel_id,
+        "project_id": ctx.pick("project_id"),
+        "project_title": ctx.pick("project_title"),
+        "board_id": ctx.pick("board_id"),
+        "column_id": ctx.pick("column_id"),
+        "assignee_id": ctx.pick("assignee_id"),
+        # пост с кнопками дедлайна — его заменит итог при вводе своей даты
+        "deadline_post_id": ctx.post_id,
+    }
+
+    if deadline_choice == "custom":
+        # Пользователь должен ввести дату текстом
+        set_state(ctx.user_id, ctx.root_post_id, updates)
+        mm_patch_post(
+            ctx.post_id,
+            message=(
+                f'Введите дату дедлайна для задачи "{ctx.task_title}" '
+                f'в этом треде в формате YYYY-MM-DD, например 2025-11-13.'
+            ),
+            attachments=[]
+        )
+    else:
+        updates["deadline"] = None if deadline_choice == "none" else calc_deadline(deadline_choice)
+        state = set_state(ctx.user_id, ctx.root_post_id, updates)
+        create_task_and_update_post(ctx.task_title, state, ctx.user_id, ctx.post_id)
 
-            set_state(user_id, root_post_id, {
-                "post_ids": state.get("post_ids", []) + [resp["id"]]
-            })
 
-        # ---------- ВЫБОР ДЕДЛАЙНА ----------
-        elif step == "CHOOSE_DEADLINE":
-            deadline_choice = context.get("deadline_choice")
-            state = set_state(user_id, root_post_id, {
-                "step": "CHOOSE_DEADLINE",
-                "deadline_choice": deadline_choice,
-            })
+# ---------- ОТМЕНА ----------
 
-            if deadline_choice == "custom":
-                # Пользователь должен ввести дату текстом
-                mm_patch_post(
-                    post_id,
-                    message=(
-                        f'Введите дату дедлайна для задачи "{task_title}" '
-                        f'в этом треде в формате YYYY-MM-DD, например 2025-11-13.'
-                    ),
-                    attachments=[]
-                )
-            elif deadline_choice == "none":
-                state = set_state(user_id, root_post_id, {
-                    "deadline": None,
-                })
-                create_task_and_update_post(task_title, state, user_id, post_id)
-            else:
-                deadline_date = calc_deadline(deadline_choice)
-                state = set_state(user_id, root_post_id, {
-                    "deadline": deadline_date,
-                })
-                create_task_and_update_post(task_title, state, user_id, post_id)
-
-        # ---------- ОТМЕНА ----------
-        elif step == "CANCEL":
-            state = get_state(user_id, root_post_id) or {}
-            channel_id_state = state.get("channel_id", channel_id)
-            post_ids = state.get("post_ids", [])
-            task_title = context.get("task_title") or state.get("task_title") or "Без названия"
-
-            # Удаляем все служебные сообщения мастера
-            for pid in post_ids:
-                try:
-                    requests.delete(
-                        f"{MM_URL}/api/v4/posts/{pid}",
-                        headers=mm_headers,
-                        timeout=5
-                    )
-                except Exception as del_e:
-                    print("Error deleting post", pid, del_e)
+def action_cancel(ctx):
+    state = ctx.state
+    channel_id_state = state.get("channel_id", ctx.channel_id)
+    post_ids = state.get("post_ids", [])
+    task_title = ctx.context.get("task_title") or state.get("task_title") or "Без названия"
 
-            clear_state(user_id, root_post_id)
+    # Удаляем все служебные сообщения мастера
+    mm_delete_posts(post_ids)
 
-            if task_title == "Без названия" or not task_title:
-                msg = "Хорошо, создание задачи отменено."
-            else:
-                msg = f'Хорошо, создание задачи "{task_title}" отменено.'
+    clear_state(ctx.user_id, ctx.root_post_id)
 
-            mm_post(
-                channel_id_state,
-                message=msg,
-                root_id=root_post_id
-            )
+    if task_title == "Без названия" or not task_title:
+        msg = "Хорошо, создание задачи отменено."
+    else:
+        msg = f'Хорошо, создание задачи "{task_title}" отменено.'
 
-            return "", 200
+    mm_post(
+        channel_id_state,
+        message=msg,
+        root_id=ctx.root_post_id
+    )
 
-        # ---------- РУЧНОЕ ЗАВЕРШЕНИЕ ДИАЛОГА ----------
-        elif step == "FINISH":
-            st = get_state(user_id, root_post_id) or {}
 
-            project_title = st.get("project_title", "без названия")
-            board_title = st.get("board_title", "без названия")
-            assignee_name = st.get("assignee_name", "не указан")
-            deadline_str = st.get("deadline_str", "без дедлайна")
-            task_url = st.get("task_url", "")
-            channel_id_state = st.get("channel_id", channel_id)
+# ---------- РУЧНОЕ ЗАВЕРШЕНИЕ ДИАЛОГА ----------
 
-            summary = build_task_summary(
-                task_title=task_title,
-                project_title=project_title,
-                board_title=board_title,
-                assignee_name=assignee_name,
-                deadline_str=deadline_str,
-                task_url=task_url,
-            )
+def action_finish(ctx):
+    st = ctx.state
 
-            # summary → в тред + в общий канал
-            send_task_summary(
-                channel_id_state,
-                root_post_id,
-                summary,
-                to_channel=True,
-                auto=False,
-            )
+    project_title = st.get("project_title", "без названия")
+    board_title = st.get("board_title", "без названия")
+    assignee_name = st.get("assignee_name", "не указан")
+    deadline_str = st.get("deadline_str", "без дедлайна")
+    task_url = st.get("task_url", "")
+    channel_id_state = st.get("channel_id", ctx.channel_id)
 
-            # Обновляем интерактивный пост
-            mm_patch_post(
-                post_id,
-                message=f'Диалог по задаче "{task_title}" завершён.',
-                attachments=[]
-            )
+    summary = build_task_summary(
+        task_title=ctx.task_title,
+        project_title=project_title,
+        board_title=board_title,
+        assignee_name=assignee_name,
+        deadline_str=deadline_str,
+        task_url=task_url,
+    )
 
-            clear_state(user_id, root_post_id)
-            return "", 200
+    # summary → в тред + в общий канал
+    send_task_summary(
+        channel_id_state,
+        ctx.root_post_id,
+        summary,
+        to_channel=True,
+        auto=False,
+    )
 
-    except Exception as e:
-        print("Error in mm_actions:", e)
-        try:
-            mm_post(channel_id, f"💥 Ошибка обработки действия бота: {e}", root_id=root_post_id)
-        except Exception:
-            pass
+    # Обновляем интерактивный пост
+    mm_patch_post(
+        ctx.post_id,
+        message=f'Диалог по задаче "{ctx.task_title}" завершён.',
+        attachments=[]
+    )
 
-    return "", 200
+    clear_state(ctx.user_id, ctx.root_post_id)
+
+
+STEP_HANDLERS = {
+    "MENU_CREATE_TASK": action_menu_create_task,
+    "MENU_SHOW_SHORTCUTS": action_menu_show_shortcuts,
+    "MENU_CHANGE_DEFAULT_PROJECT": action_menu_change_default_project,
+    "MENU_DEFAULT_PROJECT_CANCEL": action_menu_default_project_cancel,
+    "MENU_DEFAULT_PROJECT_SET": action_menu_default_project_set,
+    "MENU_CANCEL": action_menu_cancel,
+    "DEFAULT_PROJECT_PROMPT_NO": action_default_project_prompt_no,
+    "DEFAULT_PROJECT_PROMPT_YES": action_default_project_prompt_yes,
+    "DEFAULT_PROJECT_SET": action_default_project_set,
+    "CHOOSE_PROJECT": action_choose_project,
+    "CHOOSE_BOARD": action_choose_board,
+    "CHOOSE_COLUMN": action_choose_column,
+    "CHOOSE_ASSIGNEE": action_choose_assignee,
+    "CHOOSE_DEADLINE": action_choose_deadline,
+    "CANCEL": action_cancel,
+    "FINISH": action_finish,
+}
 
 
 # ---------------------------------------------------------------------------
@@ -1742,11 +2480,11 @@ def create_task_and_update_post(task_title, state, user_id, post_id):
        с action "Завершить" и приглашением добавить комментарии/файлы.
     3) Обновляет state для FINISH и автозавершения.
     """
-    mm_user = mm_get_user(user_id)
-    first_name = mm_user.get("first_name", "").strip()
-    last_name = mm_user.get("last_name", "").strip()
-    username = mm_user.get("username", "")
-    full_name = (first_name + " " + last_name).strip() or username
+    # имя автора запоминается при старте мастера; запрос в Loop — только для старых диалогов
+    full_name = state.get("author_full_name")
+    username = state.get("author_username", "")
+    if full_name is None:
+        full_name, username = mm_user_names(mm_get_user(user_id))
 
     column_id = state.get("column_id")
     assignee_id = state.get("assignee_id")
@@ -1768,8 +2506,8 @@ def create_task_and_update_post(task_title, state, user_id, post_id):
         if task_id and not task_project_id:
             full_task = yg_get_task(task_id)
             task_project_id = full_task.get("idTaskProject") or full_task.get("idTaskCommon")
-    except Exception as e:
-        print("Error fetching full YouGile task:", e)
+    except Exception:
+        logger.exception("Error fetching full YouGile task")
 
     project_title = state.get("project_title")
     project_slug = slugify_title(project_title) if project_title else ""
@@ -1803,7 +2541,7 @@ def create_task_and_update_post(task_title, state, user_id, post_id):
     #    attachments убираем — на этом сообщении больше ничего интерактивного не нужно.
     mm_patch_post(
         post_id,
-        message=f'Дедлайн для задачи "{task_title}": {deadline_str}.',
+        message=confirm_message("deadline", task_title, deadline_str),
         attachments=[]
     )
 
@@ -1826,13 +2564,14 @@ def create_task_and_update_post(task_title, state, user_id, post_id):
         post_ids = post_ids + [resp["id"]]
 
     # 3) Обновляем state для FINISH / автозавершения
-    set_state(user_id, root_post_id, {
+    st = set_state(user_id, root_post_id, {
         "step": "OPTIONAL_ATTACH",
         "yougile_task_id": task_id,
         "task_url": task_url,
         "deadline_str": deadline_str,
         "post_ids": post_ids,
     })
+    schedule_auto_finish(user_id, root_post_id, st["updated_at"] + AUTO_FINISH_SECONDS)
 
 
 def auto_finish_dialog(user_id, root_post_id):
@@ -1883,6 +2622,12 @@ def start_task_creation(user_id, channel_id, root_id, title):
     - учитываем проект по умолчанию для канала (если задан),
     - дальше: выбор доски, колонки, исполнителя, дедлайна.
     """
+    # Проект по умолчанию известен без сети: пока проверяем доступ пользователя,
+    # доски этого проекта уже грузятся (ответ в любом случае ляжет в кеш).
+    default_entry = get_default_project_for_channel(channel_id)
+    default_project_id = default_entry.get("project_id") if default_entry else None
+    boards_future = IO_POOL.submit(yg_get_boards, default_project_id) if default_project_id else None
+
     allowed_projects = get_allowed_projects_for_mm_user(user_id)
 
     # нет доступных проектов
@@ -1899,12 +2644,20 @@ def start_task_creation(user_id, channel_id, root_id, title):
         )
         return
 
-    # проверяем проект по умолчанию для этого канала
-    default_entry = get_default_project_for_channel(channel_id)
+    # пользователь обычно уже в кеше после проверки доступа; имя понадобится при создании задачи.
+    # Проверка доступа ошибки Loop глотает, так что этот запрос может упасть первым —
+    # тогда имя не запоминаем (None), и create_task_and_update_post запросит его сам.
+    try:
+        author_full_name, author_username = mm_user_names(mm_get_user(user_id))
+    except Exception:
+        logger.exception("Error fetching MM user for task author")
+        author_full_name, author_username = None, ""
+
+    # проверяем, доступен ли пользователю проект по умолчанию этого канала
     default_project = None
-    if default_entry:
+    if default_project_id:
         for p in allowed_projects:
-            if p.get("id") == default_entry.get("project_id"):
+            if p.get("id") == default_project_id:
                 default_project = p
                 break
 
@@ -1912,7 +2665,9 @@ def start_task_creation(user_id, channel_id, root_id, title):
         project_id = default_project["id"]
         project_title = default_project.get("title", "без названия")
 
-        state = set_state(user_id, root_id, {
+        # Всё, что узнаём до отправки карточки, копим в updates и пишем в state
+        # одним set_state; второй — только id отправленного поста.
+        updates = {
             "step": "CHOOSE_PROJECT",
             "task_title": title,
             "root_post_id": root_id,
@@ -1920,11 +2675,17 @@ def start_task_creation(user_id, channel_id, root_id, title):
             "project_id": project_id,
             "project_title": project_title,
             "post_ids": [],
-        })
+            "author_full_name": author_full_name,
+            "author_username": author_username,
+        }
 
-        boards = yg_get_boards(project_id)
+        IO_POOL.submit(yg_get_project_users, project_id)  # прогрев кеша к шагу выбора исполнителя
+        boards = boards_future.result()
 
         if not boards:
+            # пустой список не держим в кеше: доски могут завести, пока пользователь ждёт
+            cache_invalidate("yg_get_boards", project_id)
+            set_state(user_id, root_id, updates)
             mm_post(
                 channel_id,
                 message=f'В проекте "{project_title}" нет досок, задачу создать нельзя.',
@@ -1937,7 +2698,7 @@ def start_task_creation(user_id, channel_id, root_id, title):
             board_id = board["id"]
             board_title = board.get("title", "без названия")
 
-            state = set_state(user_id, root_id, {
+            updates.update({
                 "step": "CHOOSE_BOARD",
                 "board_id": board_id,
                 "board_title": board_title,
@@ -1945,6 +2706,8 @@ def start_task_creation(user_id, channel_id, root_id, title):
 
             columns = yg_get_columns(board_id)
             if not columns:
+                cache_invalidate("yg_get_columns", board_id)
+                set_state(user_id, root_id, updates)
                 mm_post(
                     channel_id,
                     message=f'На доске "{board_title}" нет колонок, задачу создать нельзя.',
@@ -1952,57 +2715,43 @@ def start_task_creation(user_id, channel_id, root_id, title):
                 )
                 return
 
-            column_options = {c["id"]: c.get("title", "Без имени") for c in columns if c.get("id")}
-            set_state(user_id, root_id, {"column_options": column_options})
-
-            attachments = build_column_select_for_task(title, project_id, board_id, columns, user_id, root_id)
-            resp = mm_post(
-                channel_id,
-                message=f'Выберите колонку для задачи "{title}"',
-                attachments=attachments,
-                root_id=root_id
-            )
-            set_state(user_id, root_id, {
-                "post_ids": state.get("post_ids", []) + [resp["id"]]
-            })
+            options, updates["column_options"] = build_title_options(columns)
+            attachments = build_column_select_for_task(title, project_id, board_id, options, user_id, root_id)
+            prompt_kind = "column"
         else:
-            board_options = {b["id"]: b.get("title", "Без имени") for b in boards if b.get("id")}
-            set_state(user_id, root_id, {"board_options": board_options})
-
-            attachments = build_board_select_for_task(title, project_id, boards, user_id, root_id)
-            resp = mm_post(
-                channel_id,
-                message=f'Выберите доску для задачи "{title}"',
-                attachments=attachments,
-                root_id=root_id
-            )
-            set_state(user_id, root_id, {
-                "post_ids": state.get("post_ids", []) + [resp["id"]]
-            })
+            options, updates["board_options"] = build_title_options(boards)
+            attachments = build_board_select_for_task(title, project_id, options, user_id, root_id)
+            prompt_kind = "board"
 
+        # state пишем до отправки карточки: клик по ней должен застать выбранные опции
+        set_state(user_id, root_id, updates)
+        resp = mm_post(
+            channel_id,
+            message=prompt_message(prompt_kind, title),
+            attachments=attachments,
+            root_id=root_id
+        )
+        set_state(user_id, root_id, {"post_ids": [resp["id"]]})
         return
 
     # нет проекта по умолчанию — выбираем проект select'ом
-    project_options = {
-        p["id"]: p.get("title", "Без имени")
-        for p in allowed_projects
-        if p.get("id")
-    }
+    options, project_options = build_title_options(allowed_projects)
 
-    with STATE_LOCK:
-        STATE[(user_id, root_id)] = {
-            "step": "CHOOSE_PROJECT",
-            "task_title": title,
-            "root_post_id": root_id,
-            "channel_id": channel_id,
-            "post_ids": [],
-            "project_options": project_options,
-        }
+    replace_state(user_id, root_id, {
+        "step": "CHOOSE_PROJECT",
+        "task_title": title,
+        "root_post_id": root_id,
+        "channel_id": channel_id,
+        "post_ids": [],
+        "project_options": project_options,
+        "author_full_name": author_full_name,
+        "author_username": author_username,
+    })
 
-    attachments = build_project_select_for_task(title, allowed_projects, user_id, root_id)
+    attachments = build_project_select_for_task(title, options, user_id, root_id)
     resp = mm_post(
         channel_id,
-        message=f'Выберите проект для задачи "{title}"',
+        message=prompt_message("project", title),
         attachments=attachments,
         root_id=root_id
     )
@@ -2015,21 +2764,373 @@ def start_task_creation(user_id, channel_id, root_id, title):
 #  WebSocket-бот Loop (Mattermost)
 # ---------------------------------------------------------------------------
 
-def run_ws_bot():
+# TCP keepalive для долгоживущего WS-соединения: мёртвое соединение
+# обнаруживается за минуту-другую, а не висит до следующего сообщения.
+# TCP_NODELAY: короткие кадры (auth, ping) не ждут склейки Nagle
+WS_SOCKOPTS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+if hasattr(socket, "TCP_KEEPIDLE"):  # Linux
+    WS_SOCKOPTS += [
+        (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 15),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4),
+    ]
+
+# Сколько кадров максимум забирать из сокета за один проход
+WS_MAX_BATCH = 64
+
+
+def ws_has_pending_data(ws):
+    """Есть ли в сокете WS данные, которые можно прочитать без ожидания."""
+    sock = ws.sock
+    if sock is None:
+        return False
+    # у TLS-сокета расшифрованные данные могут лежать в буфере SSL, невидимом для select
+    if isinstance(sock, ssl.SSLSocket) and sock.pending():
+        return True
+    readable, _, _ = select.select([sock], [], [], 0)
+    return bool(readable)
+
+
+# Кадры с данными; управляющие (ping/pong/close) ws.recv_data обрабатывает сам
+WS_DATA_OPCODES = (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY)
+
+
+def ws_recv_bytes(ws):
+    """
+    Принимает один кадр WS как bytes: в отличие от ws.recv(), текстовый кадр
+    не декодируется в str — json_loads (orjson) разбирает bytes напрямую.
+    """
+    opcode, data = ws.recv_data()
+    return data if opcode in WS_DATA_OPCODES else b""
+
+
+def ws_recv_batch(ws, max_batch=WS_MAX_BATCH):
+    """
+    Ждёт первый кадр WS (блокирующе), затем забирает все кадры,
+    которые уже пришли, — чтобы при всплеске событий не просыпаться на каждый кадр.
+    """
+    msgs = [ws_recv_bytes(ws)]
+    while len(msgs) < max_batch and ws_has_pending_data(ws):
+        msgs.append(ws_recv_bytes(ws))
+    return msgs
+
+
+# Отдельный пул для обработчиков событий WS: обработчики сами ждут IO_POOL,
+# поэтому делить с ним потоки нельзя.
+WS_EVENT_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="ws-event")
+# Сколько событий может ждать обработки. Когда очередь полна, поток чтения WS ждёт
+# обработчиков (back-pressure), но не дольше WS_PENDING_TIMEOUT_SECONDS: ping'и Loop
+# обрабатываются только внутри recv, а сервер рвёт соединение без pong примерно через 100 с.
+# Не дождавшись места, событие отбрасывается, а автору отвечаем в тред (report_bot_overloaded).
+WS_MAX_PENDING_EVENTS = 1000
+WS_PENDING_TIMEOUT_SECONDS = 30
+BOT_OVERLOADED_MESSAGE = "Бот сейчас перегружен и не обработал это сообщение. Повторите его чуть позже."
+WS_EVENT_DISPATCHER = OrderedDispatcher(
+    WS_EVENT_POOL,
+    max_pending=WS_MAX_PENDING_EVENTS,
+    pending_timeout=WS_PENDING_TIMEOUT_SECONDS,
+)
+
+
+def report_bot_overloaded(post):
+    """
+    Событие отброшено из-за переполненной очереди — сообщаем автору в тред, чтобы он повторил.
+    Отвечаем только на посты, адресованные боту (упоминание или тред с активным диалогом),
+    а не на всю переписку в канале.
+    """
+    channel_id = post.get("channel_id")
+    if not channel_id or post.get("type") in POST_TYPE_HANDLERS:
+        return
+    root_id = post.get("root_id") or post.get("id")
+    message = post.get("message") or ""
+    mentioned = "@" in message and BOT_MENTION_RE.search(message)
+    if not mentioned and get_state(post.get("user_id"), root_id) is None:
+        return
+    try:
+        mm_post(channel_id, BOT_OVERLOADED_MESSAGE, root_id=root_id)
+    except Exception:
+        logger.exception("Error reporting dropped WS event")
+
+
+def handle_bot_added(post):
+    """Бота ДОБАВИЛИ в канал → спросить про проект по умолчанию."""
+    channel_id = post.get("channel_id")
+    # user_id бота нужен только здесь: если при старте его получить не удалось,
+    # get_bot_user_id ходит в Loop — пусть это будет не на каждом посте.
+    bot_id = get_bot_user_id()
+    added_user_id = (post.get("props") or {}).get("addedUserId")
+    if not (bot_id and added_user_id == bot_id and channel_id):
+        return
+
+    prompt = (
+        "Я только что добавлен в этот канал.\n"
+        "Хотите установить проект по умолчанию для этого чата?"
+    )
+    attachments = [{
+        "text": "Выберите действие:",
+        "actions": [
+            {
+                "id": "defaultProjectYes",
+                "name": "Да, выбрать проект",
+                "type": "button",
+                "style": "primary",
+                "integration": action_integration("DEFAULT_PROJECT_PROMPT_YES")
+            },
+            {
+                "id": "defaultProjectNo",
+                "name": "Нет, буду задавать проект отдельно",
+                "type": "button",
+                "integration": action_integration("DEFAULT_PROJECT_PROMPT_NO")
+            },
+        ]
+    }]
+
+    mm_post(
+        channel_id,
+        message=prompt,
+        attachments=attachments,
+        root_id=None
+    )
+
+
+def handle_bot_removed(post):
+    """Бота УДАЛИЛИ из канала → чистим мэппинг."""
+    channel_id = post.get("channel_id")
+    bot_id = get_bot_user_id()
+    removed_user_id = (post.get("props") or {}).get("removedUserId")
+    if bot_id and removed_user_id == bot_id and channel_id:
+        delete_default_project_for_channel(channel_id)
+
+
+# Системные посты, на которые реагирует бот: type поста → обработчик
+POST_TYPE_HANDLERS = {
+    "system_add_to_channel": handle_bot_added,
+    "system_remove_from_channel": handle_bot_removed,
+}
+
+
+def handle_custom_deadline_input(post, st, user_id, channel_id, root_id, message):
+    """Ожидание кастомной даты дедлайна (после кнопки «Своя дата»)."""
+    if st.get("deadline_choice") != "custom":
+        return
+
+    text = (message or "").strip()
+    if not text:
+        return
+
+    try:
+        d = parse_deadline_date(text)
+    except ValueError:
+        mm_post(
+            channel_id,
+            message=(
+                f'Не удалось разобрать дату "{text}". '
+                f'Используйте формат YYYY-MM-DD, например 2025-11-13.'
+            ),
+            root_id=root_id
+        )
+        return
+
+    st = set_state(user_id, root_id, {
+        "deadline": d,
+        "deadline_display": text,  # запоминаем, что ввёл пользователь
+    })
+    task_title = st.get("task_title", "Без названия")
+
+    post_ids = st.get("post_ids") or []
+    target_post_id = st.get("deadline_post_id") or (post_ids[-1] if post_ids else None)
+
+    if target_post_id:
+        try:
+            create_task_and_update_post(task_title, st, user_id, target_post_id)
+        except CircuitOpenError:
+            report_yougile_unavailable(user_id, channel_id, root_id)
+    else:
+        mm_post(
+            channel_id,
+            message=f'✅ Задача "{task_title}" создана (кастомный дедлайн).',
+            root_id=root_id
+        )
+
+
+def handle_task_title_input(post, st, user_id, channel_id, root_id, message):
+    """Ожидание названия задачи после MENU_CREATE_TASK."""
+    title_text = (message or "").strip()
+    if not title_text:
+        return
+
+    st = set_state(user_id, root_id, {
+        "task_title": title_text
+    })
+
+    ask_post_id = st.get("ask_title_post_id")
+    if ask_post_id:
+        try:
+            mm_patch_post(
+                ask_post_id,
+                message=f'Создаём задачу "{title_text}"',
+                attachments=[]
+            )
+        except Exception:
+            logger.exception("Error patching ask_title_post")
+
+    try:
+        start_task_creation(user_id, channel_id, root_id, title_text)
+    except CircuitOpenError:
+        report_yougile_unavailable(user_id, channel_id, root_id)
+
+
+def handle_thread_comment(post, st, user_id, channel_id, root_id, message):
+    """Дополнительные комментарии / файлы после создания задачи → в чат задачи YouGile."""
+    task_id = st.get("yougile_task_id")
+    if not task_id:
+        return
+
+    sent_anything = False
+
+    # данные пользователя Loop для префикса (обычно уже лежат в state)
+    full_name = st.get("author_full_name")
+    username = st.get("author_username", "")
+    if full_name is None:
+        try:
+            full_name, username = mm_user_names(mm_get_user(user_id))
+        except Exception:
+            logger.exception("Error fetching MM user for comment prefix")
+            full_name, username = "", ""
+    full_name = full_name or "неизвестный пользователь"
+
+    def prefix_text(text: str) -> str:
+        return f"Пользователь {full_name} (@{username}) написал: {text}"
+
+    # 1. Файлы: переносим в YouGile параллельно,
+    # а сообщения в чат отправляем в исходном порядке
+    file_ids = post.get("file_ids") or []
+    # метаданные файлов Loop присылает прямо в посте — лишний GET /files/{id}/info не нужен
+    file_infos = {f.get("id"): f for f in (post.get("metadata") or {}).get("files") or []}
+    upload_futures = [
+        IO_POOL.submit(upload_mm_file_to_yougile, fid, file_infos.get(fid))
+        for fid in file_ids
+    ]
+    # предохранитель YouGile разомкнут: запросы не отправлялись, сообщаем об этом в тред
+    yg_unavailable = False
+    for upload_future in upload_futures:
+        try:
+            yg_file_url = upload_future.result()
+            file_cmd = f"/root/#file:{yg_file_url}"
+            chat_text = prefix_text(file_cmd)
+
+            yg_send_chat_message(task_id, chat_text)
+            sent_anything = True
+        except CircuitOpenError:
+            yg_unavailable = True
+        except Exception:
+            logger.exception("Error sending file to YouGile chat")
+
+    # 2. Текст
+    text = (message or "").strip()
+    if text and not yg_unavailable:
+        try:
+            chat_text = prefix_text(text)
+            yg_send_chat_message(task_id, chat_text)
+            sent_anything = True
+        except CircuitOpenError:
+            yg_unavailable = True
+        except Exception:
+            logger.exception("Error sending text comment to YouGile chat")
+
+    # Диалог не сбрасываем: повторное сообщение в тред уйдёт в ту же задачу
+    if yg_unavailable:
+        try:
+            mm_post(channel_id, YG_COMMENT_UNAVAILABLE_MESSAGE, root_id=root_id)
+        except Exception:
+            logger.exception("Error reporting YouGile outage")
+
+    # 3. Ставим реакцию
+    if sent_anything:
+        try:
+            mm_add_reaction(user_id, post.get("id"), "white_check_mark")
+        except Exception:
+            logger.exception("Error adding MM reaction")
+
+        # Сбрасываем state для данного шага — комментарий обработан
+        set_state(user_id, root_id, {})
+
+
+# Текстовый ввод в треде, которого ждёт мастер: шаг диалога → обработчик
+POST_STEP_HANDLERS = {
+    "CHOOSE_DEADLINE": handle_custom_deadline_input,
+    "ASK_TASK_TITLE": handle_task_title_input,
+    "OPTIONAL_ATTACH": handle_thread_comment,
+}
+
+
+def handle_posted_event(post):
     """
-    Подключение к WebSocket Loop (Mattermost) и обработка событий "posted":
-    - системные события добавления/удаления бота из канала,
+    Обработка события "posted":
+    - системные события добавления/удаления бота из канала (POST_TYPE_HANDLERS),
     - упоминание бота и запуск мастера/главного меню,
-    - обработка текстового ввода (название задачи, кастомный дедлайн),
-    - пересылка сообщений/файлов из треда в чат задачи YouGile.
+    - текстовый ввод и комментарии в треде по шагу диалога (POST_STEP_HANDLERS).
+    """
+    type_handler = POST_TYPE_HANDLERS.get(post.get("type") or "")
+    if type_handler:
+        type_handler(post)
+        return
+
+    channel_id = post.get("channel_id")
+    user_id = post.get("user_id")
+    message = post.get("message", "")
+    root_id = post.get("root_id") or post.get("id")
+
+    # ---------- Старт диалога: упоминание бота ----------
+    # сначала дешёвая проверка на "@" (в большинстве постов его нет),
+    # затем регулярка без учёта регистра — без копии сообщения в нижнем регистре
+    if message and "@" in message and BOT_MENTION_RE.search(message):
+        title = parse_create_command(message, MM_BOT_USERNAME)
+
+        if title:
+            # Быстрая команда: сразу запускаем мастер
+            try:
+                start_task_creation(user_id, channel_id, root_id, title)
+            except CircuitOpenError:
+                report_yougile_unavailable(user_id, channel_id, root_id)
+            return
+
+        # Иначе показываем главное меню
+        attachments = build_main_menu_attachments(user_id, root_id)
+        mm_post(
+            channel_id,
+            message="Привет! Вот что я умею:",
+            attachments=attachments,
+            root_id=root_id
+        )
+        return
+
+    # ---------- Ввод в треде по текущему шагу диалога ----------
+    st = get_state(user_id, root_id)
+    if not st:
+        return
+    step_handler = POST_STEP_HANDLERS.get(st.get("step"))
+    if step_handler:
+        step_handler(post, st, user_id, channel_id, root_id, message)
+
+
+def run_ws_bot():
+    """
+    Подключение к WebSocket Loop (Mattermost) и приём событий.
+
+    Поток чтения только принимает и разбирает кадры (пачками, см. ws_recv_batch),
+    а обработка событий "posted" (handle_posted_event) выполняется в WS_EVENT_DISPATCHER.
     """
     ws_url = MM_URL.replace("https", "wss").replace("http", "ws") + "/api/v4/websocket"
     seq = 1
 
     while True:
         try:
-            print(f"Connecting to Mattermost WS {ws_url}")
-            ws = create_connection(ws_url)
+            logger.info("Connecting to Mattermost WS %s", ws_url)
+            ws = create_connection(ws_url, sockopt=WS_SOCKOPTS)
 
             auth_msg = {
                 "seq": seq,
@@ -2039,239 +3140,64 @@ def run_ws_bot():
                 }
             }
             seq += 1
-            ws.send(json.dumps(auth_msg))
-            print("Authenticated to Mattermost WS")
+            ws.send(json_dumps(auth_msg).decode("utf-8"))
+            logger.info("Authenticated to Mattermost WS")
 
             while True:
-                msg = ws.recv()
-                if not msg:
-                    continue
-
-                try:
-                    data = json.loads(msg)
-                except Exception as e:
-                    print("WS json error:", e, str(msg)[:200])
-                    continue
-
-                event = data.get("event")
-
-                # Обрабатываем только новые посты
-                if event != "posted":
-                    continue
-
-                post = decode_mm_post_from_event(data)
-                if not post:
-                    continue
-
-                post_type = post.get("type") or ""
-                props = post.get("props") or {}
-                channel_id = post.get("channel_id")
-                user_id = post.get("user_id")
-                message = post.get("message", "")
-                root_id = post.get("root_id") or post.get("id")
-                bot_id = get_bot_user_id()
-
-                # ---------- 0) Системные события добавления/удаления бота из канала ----------
-                # Бота ДОБАВИЛИ в канал → спросить про проект по умолчанию
-                if post_type == "system_add_to_channel":
-                    added_user_id = props.get("addedUserId")
-                    if bot_id and added_user_id == bot_id and channel_id:
-                        prompt = (
-                            "Я только что добавлен в этот канал.\n"
-                            "Хотите установить проект по умолчанию для этого чата?"
-                        )
-                        attachments = [{
-                            "text": "Выберите действие:",
-                            "actions": [
-                                {
-                                    "id": "defaultProjectYes",
-                                    "name": "Да, выбрать проект",
-                                    "type": "button",
-                                    "style": "primary",
-                                    "integration": {
-                                        "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-                                        "context": {
-                                            "step": "DEFAULT_PROJECT_PROMPT_YES",
-                                        }
-                                    }
-                                },
-                                {
-                                    "id": "defaultProjectNo",
-                                    "name": "Нет, буду задавать проект отдельно",
-                                    "type": "button",
-                                    "integration": {
-                                        "url": f"{BOT_PUBLIC_URL}/mattermost/actions",
-                                        "context": {
-                                            "step": "DEFAULT_PROJECT_PROMPT_NO",
-                                        }
-                                    }
-                                },
-                            ]
-                        }]
-
-                        mm_post(
-                            channel_id,
-                            message=prompt,
-                            attachments=attachments,
-                            root_id=None
-                        )
-                    continue
-
-                # Бота УДАЛИЛИ из канала → чистим мэппинг
-                if post_type == "system_remove_from_channel":
-                    removed_user_id = props.get("removedUserId")
-                    if bot_id and removed_user_id == bot_id and channel_id:
-                        delete_default_project_for_channel(channel_id)
-                    continue
-
-                # ---------- 1) Старт диалога: упоминание бота ----------
-                if f"@{MM_BOT_USERNAME}" in (message or "").lower():
-                    title = parse_create_command(message, MM_BOT_USERNAME)
-
-                    if title:
-                        # Быстрая команда: сразу запускаем мастер
-                        start_task_creation(user_id, channel_id, root_id, title)
+                for msg in ws_recv_batch(ws):
+                    if not msg:
                         continue
 
-                    # Иначе показываем главное меню
-                    attachments = build_main_menu_attachments(user_id, root_id)
-                    mm_post(
-                        channel_id,
-                        message="Привет! Вот что я умею:",
-                        attachments=attachments,
-                        root_id=root_id
-                    )
-                    continue
-
-                # ---------- 2) Ожидание кастомной даты дедлайна ----------
-                st = get_state(user_id, root_id)
-                if st and st.get("step") == "CHOOSE_DEADLINE" and st.get("deadline_choice") == "custom":
-                    text = (message or "").strip()
-                    if text:
-                        try:
-                            d = datetime.strptime(text, "%Y-%m-%d").date()
-                        except ValueError:
-                            mm_post(
-                                channel_id,
-                                message=(
-                                    f'Не удалось разобрать дату "{text}". '
-                                    f'Используйте формат YYYY-MM-DD, например 2025-11-13.'
-                                ),
-                                root_id=root_id
-                            )
-                            continue
-
-                        st = set_state(user_id, root_id, {
-                            "deadline": d,
-                            "deadline_display": text,  # запоминаем, что ввёл пользователь
-                        })
-                        task_title = st.get("task_title", "Без названия")
-
-                        post_ids = st.get("post_ids") or []
-                        target_post_id = post_ids[-1] if post_ids else None
-
-                        if target_post_id:
-                            create_task_and_update_post(task_title, st, user_id, target_post_id)
-                        else:
-                            mm_post(
-                                channel_id,
-                                message=f'✅ Задача "{task_title}" создана (кастомный дедлайн).',
-                                root_id=root_id
-                            )
+                    # Большинство кадров — typing, status_change, channel_viewed и т.п.:
+                    # отсеиваем их поиском подстроки, не разбирая JSON
+                    if b'"posted"' not in msg and b'"user_updated"' not in msg:
                         continue
 
-                # ---------- 2b) Ожидание названия задачи после MENU_CREATE_TASK ----------
-                st = get_state(user_id, root_id)
-                if st and st.get("step") == "ASK_TASK_TITLE":
-                    title_text = (message or "").strip()
-                    if not title_text:
+                    try:
+                        data = json_loads(msg)
+                    except Exception as e:
+                        logger.warning("WS json error: %s %s", e, msg[:200].decode("utf-8", "replace"))
                         continue
 
-                    st = set_state(user_id, root_id, {
-                        "task_title": title_text
-                    })
-
-                    ask_post_id = st.get("ask_title_post_id")
-                    if ask_post_id:
-                        try:
-                            mm_patch_post(
-                                ask_post_id,
-                                message=f'Создаём задачу "{title_text}"',
-                                attachments=[]
-                            )
-                        except Exception as e:
-                            print("Error patching ask_title_post:", e)
-
-                    start_task_creation(user_id, channel_id, root_id, title_text)
-                    continue
+                    event = data.get("event")
 
-                # ---------- 3) Дополнительные комментарии / файлы после создания задачи ----------
-                st = get_state(user_id, root_id)
-                if st and st.get("step") == "OPTIONAL_ATTACH":
-                    task_id = st.get("yougile_task_id")
-                    if not task_id:
+                    # Пользователь сменил имя/логин — сбрасываем его запись в кеше
+                    if event == "user_updated":
+                        updated_user = (data.get("data") or {}).get("user") or {}
+                        if updated_user.get("id"):
+                            cache_invalidate("mm_get_user", updated_user["id"])
                         continue
 
-                    sent_anything = False
+                    # Остальное — только новые посты
+                    if event != "posted":
+                        continue
 
-                    # данные пользователя Loop для префикса
                     try:
-                        mm_user = mm_get_user(user_id)
+                        post = decode_mm_post_from_event(data)
                     except Exception as e:
-                        print("Error fetching MM user for comment prefix:", e)
-                        mm_user = {}
-
-                    first_name = (mm_user.get("first_name") or "").strip()
-                    last_name = (mm_user.get("last_name") or "").strip()
-                    username = mm_user.get("username") or ""
-                    full_name = (first_name + " " + last_name).strip() or username or "неизвестный пользователь"
-
-                    def prefix_text(text: str) -> str:
-                        return f"Пользователь {full_name} (@{username}) написал: {text}"
-
-                    # 3.1. Файлы
-                    file_ids = post.get("file_ids") or []
-                    for fid in file_ids:
-                        try:
-                            file_bytes = mm_get_file(fid)
-                            info = mm_get_file_info(fid)
-                            filename = info.get("name") or info.get("id") or "file"
-                            mimetype = info.get("mime_type") or "application/octet-stream"
-
-                            yg_file_url = yg_upload_file(file_bytes, filename, mimetype)
-                            file_cmd = f"/root/#file:{yg_file_url}"
-                            chat_text = prefix_text(file_cmd)
-
-                            yg_send_chat_message(task_id, chat_text)
-                            sent_anything = True
-                        except Exception as e:
-                            print("Error sending file to YouGile chat:", e)
-
-                    # 3.2. Текст
-                    text = (message or "").strip()
-                    if text:
-                        try:
-                            chat_text = prefix_text(text)
-                            yg_send_chat_message(task_id, chat_text)
-                            sent_anything = True
-                        except Exception as e:
-                            print("Error sending text comment to YouGile chat:", e)
-
-                    # 3.3. Ставим реакцию
-                    if sent_anything:
-                        try:
-                            mm_add_reaction(user_id, post.get("id"), "white_check_mark")
-                        except Exception as e:
-                            print("Error adding MM reaction:", e)
-
-                        # Сбрасываем state для данного шага — комментарий обработан
-                        set_state(user_id, root_id, {})
+                        logger.warning("WS post json error: %s", e)
+                        continue
+                    if not post:
+                        continue
+
+                    # Собственные посты бота (карточки, ответы) обрабатывать незачем;
+                    # системные посты о добавлении/удалении проверяются по props, их не пропускаем
+                    if (
+                        post.get("user_id") == BOT_USER_ID
+                        and post.get("type") not in POST_TYPE_HANDLERS
+                    ):
+                        continue
+
+                    # события одного канала обрабатываются строго по порядку
+                    if not WS_EVENT_DISPATCHER.submit(post.get("channel_id"), handle_posted_event, post):
+                        # ответ — в IO_POOL: поток чтения WS не должен ждать ещё и Loop
+                        IO_POOL.submit(report_bot_overloaded, post)
 
         except WebSocketConnectionClosedException:
-            print("WS closed, reconnecting in 3s...")
+            logger.warning("WS closed, reconnecting in 3s...")
             time.sleep(3)
-        except Exception as e:
-            print("WS error:", e)
+        except Exception:
+            logger.exception("WS error")
             time.sleep(5)
 
 
@@ -2285,31 +3211,79 @@ def start_ws_thread():
 #  Авто-уборка зависших диалогов (автозавершение)
 # ---------------------------------------------------------------------------
 
+AUTO_FINISH_SECONDS = AUTO_FINISH_TIMEOUT_MINUTES * 60
+# Как часто удалять брошенные диалоги (reap_stale_states)
+CLEANUP_INTERVAL_SECONDS = 60
+
+# Очередь автозавершения: куча (момент автозавершения, user_id, root_post_id).
+# Пополняется при переходе диалога в OPTIONAL_ATTACH; активность в треде
+# не трогает очередь — срок перепроверяется по updated_at, когда запись всплывает.
+AUTO_FINISH_QUEUE = []
+AUTO_FINISH_LOCK = threading.Lock()
+
+
+def schedule_auto_finish(user_id, root_post_id, finish_at):
+    """Ставит диалог в очередь автозавершения на момент finish_at (time.time())."""
+    with AUTO_FINISH_LOCK:
+        heapq.heappush(AUTO_FINISH_QUEUE, (finish_at, user_id, root_post_id))
+
+
+def pop_due_auto_finish(now):
+    """Забирает из очереди все диалоги, срок которых наступил к моменту now."""
+    due = []
+    with AUTO_FINISH_LOCK:
+        while AUTO_FINISH_QUEUE and AUTO_FINISH_QUEUE[0][0] <= now:
+            _, user_id, root_post_id = heapq.heappop(AUTO_FINISH_QUEUE)
+            due.append((user_id, root_post_id))
+    return due
+
+
+def next_auto_finish_at():
+    """Ближайший момент автозавершения или None, если очередь пуста."""
+    with AUTO_FINISH_LOCK:
+        return AUTO_FINISH_QUEUE[0][0] if AUTO_FINISH_QUEUE else None
+
+
 def auto_cleanup_loop():
     """
-    Раз в минуту просматривает STATE и автозавершает диалоги,
-    которые давно в состоянии OPTIONAL_ATTACH.
+    Автозавершает диалоги, которые дольше AUTO_FINISH_TIMEOUT_MINUTES в OPTIONAL_ATTACH
+    (просыпаясь к ближайшему сроку из AUTO_FINISH_QUEUE), и раз в минуту удаляет
+    брошенные на любом шаге диалоги (см. reap_stale_states).
     """
+    next_reap_at = 0
     while True:
         try:
             now = time.time()
-            with STATE_LOCK:
-                items = list(STATE.items())
-            for (user_id, root_post_id), st in items:
-                if st.get("step") != "OPTIONAL_ATTACH":
+            for user_id, root_post_id in pop_due_auto_finish(now):
+                st = get_state(user_id, root_post_id)
+                if not st or st.get("step") != "OPTIONAL_ATTACH":
                     continue
-                updated_at = st.get("updated_at") or st.get("created_at")
-                if not updated_at:
+                finish_at = st["updated_at"] + AUTO_FINISH_SECONDS
+                if finish_at > now:
+                    # в треде была активность — переносим срок
+                    schedule_auto_finish(user_id, root_post_id, finish_at)
                     continue
-                if now - updated_at > AUTO_FINISH_TIMEOUT_MINUTES * 60:
-                    print(f"Auto-finishing dialog for user={user_id}, root={root_post_id}")
-                    try:
-                        auto_finish_dialog(user_id, root_post_id)
-                    except Exception as e:
-                        print("Error in auto_finish_dialog:", e)
-        except Exception as e:
-            print("Error in auto_cleanup_loop:", e)
-        time.sleep(60)
+                logger.info("Auto-finishing dialog for user=%s, root=%s", user_id, root_post_id)
+                try:
+                    auto_finish_dialog(user_id, root_post_id)
+                except Exception:
+                    logger.exception("Error in auto_finish_dialog")
+                    schedule_auto_finish(user_id, root_post_id, now + CLEANUP_INTERVAL_SECONDS)
+
+            if now >= next_reap_at:
+                next_reap_at = now + CLEANUP_INTERVAL_SECONDS
+                reaped = reap_stale_states(now)
+                if reaped:
+                    logger.info("Reaped %d stale dialog(s)", reaped)
+        except Exception:
+            logger.exception("Error in auto_cleanup_loop")
+
+        # спим до ближайшего автозавершения, но не дольше чем до следующей уборки
+        wake_at = next_reap_at
+        finish_at = next_auto_finish_at()
+        if finish_at is not None:
+            wake_at = min(wake_at, finish_at)
+        time.sleep(min(max(wake_at - time.time(), 1), CLEANUP_INTERVAL_SECONDS))
 
 
 def start_cleanup_thread():
@@ -2318,12 +3292,43 @@ def start_cleanup_thread():
     t.start()
 
 
+def channel_map_flush_loop():
+    """Ждёт изменений мэппинга канал → проект и пачкой сбрасывает их на диск."""
+    while True:
+        CHANNEL_MAP_DIRTY.wait()
+        # даём накопиться соседним изменениям, чтобы записать их одним файлом
+        time.sleep(CHANNEL_MAP_FLUSH_DELAY)
+        try:
+            flush_channel_map()
+        except Exception:
+            logger.exception("Error in channel_map_flush_loop")
+
+
+def start_channel_map_flush_thread():
+    """Стартует поток отложенной записи мэппинга канал → проект."""
+    t = threading.Thread(target=channel_map_flush_loop, daemon=True)
+    t.start()
+
+
 # ---------------------------------------------------------------------------
 #  MAIN
 # ---------------------------------------------------------------------------
 
-if __name__ == "__main__":
+def start_bot():
+    """
+    Запуск фоновой части бота: мэппинг каналов, WebSocket, авто-уборка.
+    Вызывается один раз на процесс — из __main__ или из хука gunicorn (gunicorn.conf.py).
+    """
+    setup_logging()
     load_channel_map()
+    refresh_bot_user_id()
+    atexit.register(flush_channel_map)
+    start_channel_map_flush_thread()
+    start_yg_warm_up_thread()
     start_ws_thread()
     start_cleanup_thread()
-    app.run(host="0.0.0.0", port=8000)
\ No newline at end of file
+
+
+if __name__ == "__main__":
+    start_bot()
+    app.run(host="0.0.0.0", port=8000, threaded=True)
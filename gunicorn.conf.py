@@ -0,0 +1,21 @@
+# Конфигурация gunicorn для бота: gunicorn -c gunicorn.conf.py app:app
+
+bind = "0.0.0.0:8000"
+
+# Ровно один процесс: состояние диалогов хранится в памяти,
+# а WebSocket-подключение к Loop должно быть единственным.
+# Параллельность — за счёт потоков (webhook'и почти целиком ждут сеть).
+workers = 1
+worker_class = "gthread"
+threads = 16
+
+keepalive = 30
+timeout = 30
+
+# max_requests не задаём: перезапуск воркера сбросил бы незавершённые диалоги.
+
+
+def post_worker_init(worker):
+    """Фоновые потоки бота стартуют в воркере, после fork."""
+    import app
+    app.start_bot()